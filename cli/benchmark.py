@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Benchmark the ProjectMemory pipeline and the get command on synthetic repositories.
+
+Every stage runs in a fresh interpreter, the way the CLI does, so "cold" and
+"warm" mean an empty versus a populated on-disk cache and peak memory is the
+stage's own high-water mark. End-to-end runs talk to a local stub of
+/api/perspectives, so no network or API key is needed.
+
+    ./benchmark.py --files 5000 --output before.json
+    ./benchmark.py --files 5000 --compare before.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import math
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+CLI_PATH = Path(__file__).resolve().parent / "perspectives.py"
+
+# Bump when stages or metrics change meaning, so old results aren't compared against new ones
+RESULTS_VERSION = 1
+
+WORDS = """
+user account session token request response handler client server cache index query
+result config option parser buffer stream event message queue worker task job
+schedule retry timeout error status record field schema model table column row
+file path directory scan match pattern filter sort merge split render layout
+widget button form input value state store action reducer effect hook context
+provider service router route controller view template payment invoice order
+customer product price discount shipping address email notify report metric
+""".split()
+
+# Fake dependency and build trees the scanner should prune without descending
+NOISE_DIRS = ["node_modules", ".git/objects", "dist", "build", ".next/cache", "__pycache__"]
+
+SIZE_CAP = 400000
+
+def identifier(rng: random.Random, style: str) -> str:
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    if style == "camel":
+        return words[0] + "".join(word.title() for word in words[1:])
+    if style == "pascal":
+        return "".join(word.title() for word in words)
+    return "_".join(words)
+
+def python_source(rng: random.Random, size: int) -> str:
+    parts = [f'"""{" ".join(rng.sample(WORDS, 6))}"""\n\nimport os\nimport json\n']
+    while sum(map(len, parts)) < size:
+        if rng.random() < 0.3:
+            parts.append(f"\nclass {identifier(rng, 'pascal')}:\n"
+                         f"    def __init__(self, {identifier(rng, 'snake')}):\n"
+                         f"        self.{identifier(rng, 'snake')} = {{}}\n")
+        name, arg = identifier(rng, "snake"), identifier(rng, "snake")
+        body = "".join(f"    {identifier(rng, 'snake')} = {arg}.get({identifier(rng, 'snake')!r})\n"
+                       for _ in range(rng.randint(2, 12)))
+        parts.append(f"\ndef {name}({arg}):\n    \"\"\"{' '.join(rng.sample(WORDS, 5))}\"\"\"\n{body}"
+                     f"    return {arg}\n")
+    return "".join(parts)
+
+def typescript_source(rng: random.Random, size: int) -> str:
+    parts = [f"import {{ {identifier(rng, 'pascal')} }} from './{identifier(rng, 'camel')}';\n"]
+    while sum(map(len, parts)) < size:
+        name, arg = identifier(rng, "camel"), identifier(rng, "camel")
+        body = "".join(f"  const {identifier(rng, 'camel')} = {arg}.{identifier(rng, 'camel')}();\n"
+                       for _ in range(rng.randint(2, 12)))
+        parts.append(f"\nexport function {name}({arg}: {identifier(rng, 'pascal')}) {{\n{body}"
+                     f"  return {arg};\n}}\n")
+    return "".join(parts)
+
+def markdown_source(rng: random.Random, size: int) -> str:
+    parts = [f"# {' '.join(rng.sample(WORDS, 3)).title()}\n"]
+    while sum(map(len, parts)) < size:
+        parts.append(f"\n## {identifier(rng, 'pascal')}\n\n" +
+                     " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) + ".\n")
+    return "".join(parts)
+
+def json_source(rng: random.Random, size: int) -> str:
+    data = {}
+    while len(data) * 40 < size:
+        data[identifier(rng, "camel")] = {identifier(rng, "snake"): rng.randint(0, 10 ** 6) for _ in range(3)}
+    return json.dumps(data, indent=2)
+
+GENERATORS = [(".py", python_source, 0.4), (".ts", typescript_source, 0.3),
+              (".md", markdown_source, 0.15), (".json", json_source, 0.15)]
+
+def generate_repo(root: Path, files: int, median_size: int, size_sigma: float, noise_files: int,
+                  files_per_dir: int = 20, seed: int = 0) -> Dict[str, Any]:
+    """Write a synthetic project under root and describe it.
+    
+    File sizes are log-normal around median_size (capped at SIZE_CAP, so a few files
+    exceed the 100 KB extraction limit); noise_files go under NOISE_DIRS.
+    """
+    rng = random.Random(seed)
+    extensions, generators, weights = zip(*[(ext, gen, weight) for ext, gen, weight in GENERATORS])
+    total_bytes = 0
+    
+    dirs = [Path("src")]
+    for index in range(files):
+        if index % files_per_dir == 0 and index:
+            # Grow the tree a few levels deep, branching off a random existing directory
+            parent = rng.choice(dirs)
+            dirs.append(parent / identifier(rng, "snake") if len(parent.parts) < 5 else Path("src") / identifier(rng, "snake"))
+        
+        choice = rng.choices(range(len(extensions)), weights)[0]
+        size = min(SIZE_CAP, int(rng.lognormvariate(math.log(median_size), size_sigma)))
+        path = root / dirs[-1] / f"{identifier(rng, 'snake')}_{index}{extensions[choice]}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        content = generators[choice](rng, size)
+        path.write_text(content, encoding="utf-8")
+        total_bytes += len(content)
+    
+    for index in range(noise_files):
+        path = root / rng.choice(NOISE_DIRS) / identifier(rng, "snake") / f"index_{index}.js"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(typescript_source(rng, rng.randint(200, 4000)), encoding="utf-8")
+    
+    return {"files": files, "bytes": total_bytes, "noise_files": noise_files, "median_size": median_size,
+            "size_sigma": size_sigma, "seed": seed}
+
+def generate_queries(count: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed + 1)
+    return [f"How does {identifier(rng, 'snake')} handle the {' '.join(rng.sample(WORDS, 3))}?"
+            for _ in range(count)]
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def run_stage(stage: str, repo: str, cache_dir: str, retriever: str, queries: List[str]) -> Dict[str, Any]:
+    """Run one stage in this (fresh) interpreter and measure it"""
+    import contextlib
+    import io
+    
+    start = time.perf_counter()
+    sys.path.insert(0, str(CLI_PATH.parent))
+    import perspectives
+    memory = perspectives.ProjectMemory(repo, cache_dir=cache_dir, retriever=retriever)
+    setup_s = time.perf_counter() - start
+    baseline_rss = peak_rss_bytes()
+    
+    result = {}
+    latencies = []
+    # The pipeline reports progress on stderr; keep it out of the harness output
+    with contextlib.redirect_stderr(io.StringIO()):
+        if stage == "query_warm":
+            # Load the index into this process first, so only steady-state queries are timed
+            memory.select_relevant_snippets(queries[0])
+        start = time.perf_counter()
+        if stage.startswith("scan"):
+            files = memory.scan_project_files()
+            result["files_scanned"] = len(files)
+            result["files_read"] = sum(not file_info["unchanged"] for file_info in files)
+        elif stage.startswith("build"):
+            result["documents"] = len(memory.build_corpus())
+        else:
+            for query in queries:
+                query_start = time.perf_counter()
+                context = memory.select_relevant_snippets(query)
+                latencies.append(time.perf_counter() - query_start)
+            result["context_chars"] = len(context)
+        seconds = time.perf_counter() - start
+    memory.close()
+    
+    result.update({"seconds": round(seconds, 4), "setup_seconds": round(setup_s, 4),
+                   "peak_rss_bytes": peak_rss_bytes(), "rss_growth_bytes": peak_rss_bytes() - baseline_rss})
+    if len(latencies) > 1:
+        latencies.sort()
+        result["queries"] = len(latencies)
+        result["p50_seconds"] = round(latencies[len(latencies) // 2], 4)
+        result["p95_seconds"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+    return result
+
+def spawn_stage(stage: str, repo: Path, cache_dir: Path, retriever: str, queries: List[str]) -> Dict[str, Any]:
+    command = [sys.executable, os.path.abspath(__file__), "_stage", stage, str(repo), str(cache_dir),
+               "--retriever", retriever, "--queries", json.dumps(queries)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"Stage {stage} failed:\n{result.stderr}")
+    return json.loads(result.stdout)
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers /api/perspectives with a canned response after server.latency seconds"""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.request_bytes.append(len(body))
+        request_data = json.loads(body)
+        time.sleep(self.server.latency)
+        
+        responses = [{"model": model, "content": f"Perspective from {model}", "tokens_used": 10,
+                      "latency_ms": int(self.server.latency * 1000)} for model in request_data["models"]]
+        payload = json.dumps({"responses": responses, "total_tokens": 10 * len(responses),
+                              "total_latency_ms": int(self.server.latency * 1000), "cached": False}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_stub_server(latency: float = 0.0) -> ThreadingHTTPServer:
+    """Serve StubHandler on an ephemeral localhost port from a daemon thread"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.latency = latency
+    server.request_bytes = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_end_to_end(repo: Path, home: Path, queries: List[str], retriever: str, stub_latency: float) -> Dict[str, Any]:
+    """Time `get --output json` against the stub: the first run on an empty cache, then warm runs"""
+    server = start_stub_server(stub_latency)
+    config_dir = home / ".polydev"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    (config_dir / "config.json").write_text(json.dumps({
+        "api_url": f"http://127.0.0.1:{server.server_address[1]}/api/perspectives",
+        "retriever": retriever
+    }))
+    env = dict(os.environ, HOME=str(home))
+    env.pop("POLYDEV_API_TOKEN", None)
+    
+    latencies = []
+    try:
+        for query in queries:
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, str(CLI_PATH), "get", query, "--project-root", str(repo),
+                                     "--output", "json", "--no-daemon"], capture_output=True, text=True, env=env)
+            latencies.append(time.perf_counter() - start)
+            if result.returncode:
+                raise RuntimeError(f"get failed:\n{result.stderr}")
+    finally:
+        server.shutdown()
+    
+    warm = sorted(latencies[1:]) or latencies
+    return {"cold_seconds": round(latencies[0], 4), "warm_p50_seconds": round(warm[len(warm) // 2], 4),
+            "warm_max_seconds": round(warm[-1], 4), "runs": len(latencies),
+            "stub_latency_seconds": stub_latency,
+            "request_bytes": max(server.request_bytes) if server.request_bytes else 0}
+
+def git_revision() -> Optional[str]:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CLI_PATH.parent,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=CLI_PATH.parent,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if dirty else revision
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    work_dir = Path(tempfile.mkdtemp(prefix="polydev-bench-"))
+    repo = Path(args.repo) if args.repo else work_dir / "repo"
+    try:
+        if args.repo and repo.exists():
+            repo_info = {"path": str(repo), "generated": False}
+        else:
+            print(f"Generating {args.files} files in {repo}...", file=sys.stderr)
+            repo_info = generate_repo(repo, args.files, args.median_size, args.size_sigma, args.noise_files,
+                                      seed=args.seed)
+            repo_info["generated"] = True
+        
+        queries = generate_queries(args.queries, args.seed)
+        cache_dir = work_dir / "cache"
+        stages = {}
+        
+        # Order matters: each stage leaves the cache in the state the next one expects
+        for stage, stage_queries in [("scan_cold", []), ("build_cold", []), ("scan_warm", []), ("build_warm", []),
+                                     ("query_first", queries[:1]), ("query_warm", queries)]:
+            print(f"Running {stage}...", file=sys.stderr)
+            stages[stage] = spawn_stage(stage, repo, cache_dir, args.retriever, stage_queries)
+        
+        if args.e2e_runs:
+            print("Running end_to_end...", file=sys.stderr)
+            stages["end_to_end"] = run_end_to_end(repo, work_dir / "home", queries[:args.e2e_runs], args.retriever,
+                                                  args.stub_latency)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    return {
+        "version": RESULTS_VERSION,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "retriever": args.retriever,
+        "repo": repo_info,
+        "stages": stages
+    }
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any]) -> str:
+    """Side-by-side table of every numeric stage metric the two results share"""
+    if baseline.get("version") != current.get("version"):
+        return f"Results versions differ ({baseline.get('version')} vs {current.get('version')}); not comparing"
+    
+    lines = []
+    if any(baseline.get(key) != current.get(key) for key in ("repo", "retriever")):
+        lines.append("Warning: the results were measured on different repositories or retrievers")
+    lines.append(f"{'metric':<36} {baseline.get('revision') or 'baseline':>14} {current.get('revision') or 'current':>14}  change")
+    for stage, metrics in current["stages"].items():
+        for metric, value in metrics.items():
+            before = baseline["stages"].get(stage, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+                continue
+            change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+            lines.append(f"{stage + '.' + metric:<36} {before:>14} {value:>14}  {change}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Polydev Perspectives project memory pipeline")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    # Internal: one stage in a fresh interpreter, result as JSON on stdout
+    stage_parser = subparsers.add_parser("_stage")
+    stage_parser.add_argument("stage")
+    stage_parser.add_argument("repo")
+    stage_parser.add_argument("cache_dir")
+    stage_parser.add_argument("--retriever", default="sklearn")
+    stage_parser.add_argument("--queries", default="[]")
+    
+    parser.add_argument("--files", type=int, default=2000, help="Source files in the synthetic repository")
+    parser.add_argument("--median-size", type=int, default=3000, help="Median file size in bytes")
+    parser.add_argument("--size-sigma", type=float, default=1.0, help="Spread of the log-normal size distribution")
+    parser.add_argument("--noise-files", type=int, default=2000,
+                        help="Files under node_modules/, dist/, .git/ and other excluded directories")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the repository and the queries")
+    parser.add_argument("--repo", help="Benchmark this directory (generated there first if it doesn't exist)")
+    parser.add_argument("--retriever", choices=["sklearn", "builtin"], default="sklearn")
+    parser.add_argument("--queries", type=int, default=20, help="Queries timed in the query_warm stage")
+    parser.add_argument("--e2e-runs", type=int, default=5,
+                        help="get invocations against the stub API, the first on an empty cache (0 to skip)")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds the stub API waits before answering")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="Print a comparison against an earlier results file")
+    
+    args = parser.parse_args()
+    
+    if args.command == "_stage":
+        print(json.dumps(run_stage(args.stage, args.repo, args.cache_dir, args.retriever, json.loads(args.queries))))
+        return
+    
+    results = run_benchmark(args)
+    
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_results(json.load(f), results), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
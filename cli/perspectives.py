@@ -1,31 +1,1367 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import os
 import sys
 import json
 import argparse
+import math
 import sqlite3
 import hashlib
+import importlib
+import mmap
+import subprocess
+import threading
 import time
+import re
+import zlib
+import ast
+import random
+import itertools
+from collections import Counter
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
-import requests
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Iterable, TYPE_CHECKING
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+    
+    numpy and requests take hundreds of milliseconds to import, so config/keys
+    commands that never touch them shouldn't pay for them at startup.
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+if TYPE_CHECKING:
+    import numpy as np
+    import requests
+    from scipy import sparse
+else:
+    np = LazyModule("numpy")
+    requests = LazyModule("requests")
+    sparse = LazyModule("scipy.sparse")
+
+# Import budget for the CLI module itself, checked by --profile-startup
+STARTUP_BUDGET_MS = 150
+
+# Keep IN (...) lookups below SQLite's default host parameter limit
+SQLITE_BATCH_SIZE = 500
+
+# Responses worth retrying: rate limiting and transient server/gateway failures
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Seconds the daemon waits for a connected client's next request line before hanging up
+DAEMON_READ_TIMEOUT = 30
+
+class Timings:
+    """Nested timing spans and counters for the hot paths, reported by get --timings.
+    
+    Disabled by default, so spans cost one attribute check and long-lived processes
+    like the daemon don't accumulate them. Work handed to a thread pool through bind()
+    is recorded under the span that was open where it was submitted.
+    """
+    
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        # (name, start, duration, depth, thread id, span id, parent span id), start relative to origin
+        self.spans = []
+        self.counters = Counter()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+    
+    def _open_span(self) -> Optional[Tuple[int, int]]:
+        """(id, depth) of the innermost span open on this thread, else of the one bound to it"""
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else getattr(self._local, "parent", None)
+    
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        
+        parent = self._open_span()
+        span_id = next(self._ids)
+        depth = parent[1] + 1 if parent else 0
+        if getattr(self._local, "stack", None) is None:
+            self._local.stack = []
+        self._local.stack.append((span_id, depth))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self._local.stack.pop()
+            with self._lock:
+                self.spans.append((name, start - self.origin, duration, depth, threading.get_ident(), span_id,
+                                   parent and parent[0]))
+    
+    def bind(self, fn):
+        """fn, wrapped so the spans it opens on a worker thread nest under the span open here"""
+        if not self.enabled:
+            return fn
+        
+        parent = self._open_span()
+        def run(*args, **kwargs):
+            outer = getattr(self._local, "parent", None)
+            self._local.parent = parent
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.parent = outer
+        return run
+    
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+    
+    def report(self) -> str:
+        """Indented span tree with each span's share of the outermost ones, then counters.
+        
+        Children run on the parent's thread are listed in start order; children that ran
+        concurrently on worker threads follow, grouped and labelled by thread. Only the
+        outermost spans add up to the total.
+        """
+        children = {}
+        for span in sorted(self.spans, key=lambda span: span[1]):
+            children.setdefault(span[6], []).append(span)
+        total = sum(span[2] for span in children.get(None, [])) or 1e-9
+        
+        rows = []
+        def add(spans, thread):
+            workers = list(dict.fromkeys(span[4] for span in spans if span[4] != thread))
+            for span in sorted(spans, key=lambda span: (workers.index(span[4]) + 1 if span[4] in workers else 0, span[1])):
+                label = f"{span[0]} [worker {workers.index(span[4]) + 1}]" if span[4] in workers else span[0]
+                rows.append(("  " * span[3] + label, span[2]))
+                add(children.get(span[5], []), span[4])
+        add(children.get(None, []), threading.main_thread().ident)
+        width = max([len(label) for label, _ in rows] + [len(name) for name in self.counters] + [8])
+        
+        lines = [f"Timings (total {total * 1000:.1f}ms):"]
+        for label, duration in rows:
+            lines.append(f"  {label:<{width}}  {duration * 1000:9.1f}ms  {duration / total * 100:5.1f}%")
+        if self.counters:
+            lines.append("Counters:")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"  {name:<{width}}  {value:>11}")
+        return "\n".join(lines)
+    
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "spans": [{"name": name, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3),
+                       "depth": depth, "thread": thread, "id": span_id, "parent": parent}
+                      for name, start, duration, depth, thread, span_id, parent in sorted(self.spans,
+                                                                                            key=lambda span: span[1])],
+            "counters": dict(self.counters)
+        }
+    
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Trace Event Format, loadable in chrome://tracing or Perfetto"""
+        pid = os.getpid()
+        events = [{"name": name, "cat": "polydev", "ph": "X", "ts": round(start * 1e6, 1),
+                   "dur": round(duration * 1e6, 1), "pid": pid, "tid": thread}
+                  for name, start, duration, _, thread, _, _ in self.spans]
+        end = max((start + duration for _, start, duration, *_ in self.spans), default=0)
+        events += [{"name": name, "ph": "C", "ts": round(end * 1e6, 1), "pid": pid, "args": {name: value}}
+                   for name, value in self.counters.items()]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    
+    def export(self, path: str, fmt: str = "json"):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace() if fmt == "chrome" else self.to_json(), f, indent=2)
+
+timings = Timings()
+
+def glob_to_regex(pattern: str, anchored: bool = False) -> str:
+    """Translate a glob into a regex over '/'-separated relative paths.
+    
+    `**` spans directories (including none), `*` and `?` stay within one path segment.
+    Unanchored patterns match at any depth, the way Path.match matched from the right.
+    """
+    if pattern.startswith("/"):
+        pattern, anchored = pattern[1:], True
+    
+    parts = [] if anchored or pattern.startswith("**/") else ["(?:.*/)?"]
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            # As in fnmatch: a "]" right after "[" or "[!" is a member, not the end of the set
+            j = i + 1
+            if pattern.startswith("!", j):
+                j += 1
+            if pattern.startswith("]", j):
+                j += 1
+            close = pattern.find("]", j)
+            if close == -1:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:close].replace("\\", "\\\\").replace("[", "\\[")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                elif body.startswith("^"):
+                    body = "\\" + body
+                parts.append(f"[{body}]")
+                i = close
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    
+    return "".join(parts)
+
+class PathMatcher:
+    """Include/exclude globs compiled once into single regexes.
+    
+    Excludes of the form `dir/**` (or `dir/`) also prune whole directories during the walk,
+    so nothing below them is ever listed.
+    """
+    
+    def __init__(self, includes: List[str], excludes: List[str]):
+        self.include_re = self.compile(includes)
+        self.exclude_re = self.compile(excludes)
+        self.prune_re = self.compile(
+            [p[:-3] for p in excludes if p.endswith("/**")] + [p.rstrip("/") for p in excludes if p.endswith("/")]
+        )
+    
+    @staticmethod
+    def compile(patterns: List[str]) -> Optional["re.Pattern"]:
+        regexes = []
+        for pattern in patterns:
+            regex = glob_to_regex(pattern)
+            try:
+                re.compile(regex)
+            except re.error as e:
+                print(f"Ignoring pattern {pattern!r}: {e}", file=sys.stderr)
+                continue
+            regexes.append(regex)
+        
+        if not regexes:
+            return None
+        return re.compile("(?:" + "|".join(regexes) + r")\Z")
+    
+    def prune_dir(self, rel_dir: str) -> bool:
+        """Whether a directory (relative path, no trailing slash) should not be descended into"""
+        return self.prune_re is not None and self.prune_re.match(rel_dir) is not None
+    
+    def match_file(self, rel_path: str) -> bool:
+        """Whether a file (relative path) passes the excludes and matches an include"""
+        if self.exclude_re is not None and self.exclude_re.match(rel_path):
+            return False
+        return self.include_re is not None and self.include_re.match(rel_path) is not None
+
+@lru_cache(maxsize=16)
+def compile_matcher(includes: Tuple[str, ...], excludes: Tuple[str, ...]) -> PathMatcher:
+    """Compile (and memoize) the matcher for a pattern set"""
+    return PathMatcher(list(includes), list(excludes))
+
+def parse_gitignore(gitignore_path: str, base: str) -> List[Tuple["re.Pattern", bool, bool]]:
+    """Parse a .gitignore into (regex, negated, dir_only) rules relative to its directory.
+    
+    `base` is the directory of the .gitignore relative to the project root, with a trailing
+    slash (empty for the root).
+    """
+    rules = []
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+        
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        
+        # A slash anywhere but the end anchors the pattern to the .gitignore's directory
+        anchored = "/" in line
+        regex = re.escape(base) + glob_to_regex(line.lstrip("/"), anchored=anchored)
+        try:
+            rules.append((re.compile(regex + r"\Z"), negated, dir_only))
+        except re.error:
+            continue  # A line git couldn't match either
+    
+    return rules
+
+def is_gitignored(rules: List[Tuple["re.Pattern", bool, bool]], rel_path: str, is_dir: bool) -> bool:
+    """Evaluate gitignore rules in order; the last matching rule wins"""
+    ignored = False
+    for regex, negated, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(rel_path):
+            ignored = not negated
+    return ignored
+
+def find_git_checkout(path: Path) -> Optional[Tuple[Path, Path]]:
+    """(worktree top, git dir) of the checkout containing path, None outside one"""
+    for top in (path, *path.parents):
+        dot_git = top / ".git"
+        if dot_git.is_dir():
+            return top, dot_git
+        if dot_git.is_file():
+            # Linked worktrees and submodules point at their git dir
+            text = dot_git.read_text(errors='ignore').strip()
+            return (top, (top / text[7:].strip()).resolve()) if text.startswith("gitdir:") else None
+    return None
+
+def git_uses_sha1(git_dir: Path) -> bool:
+    """Whether the repository's object ids are SHA-1 (not SHA-256), which read_git_index assumes"""
+    common_dir = git_dir
+    if (git_dir / "commondir").is_file():
+        common_dir = (git_dir / (git_dir / "commondir").read_text().strip()).resolve()
+    try:
+        config = (common_dir / "config").read_text(errors='ignore')
+    except OSError:
+        return True
+    return not re.search(r"^\s*objectformat\s*=\s*sha256\s*$", config, re.IGNORECASE | re.MULTILINE)
+
+def read_git_index(index_path: Path) -> Optional[Dict[str, Tuple[int, int, int, int, Optional[str]]]]:
+    """Regular files in a git index: path -> (mtime s, mtime ns, size, inode, blob SHA-1).
+    
+    Reads index versions 2 to 4 directly, without running git. Entries git can't vouch
+    for (unmerged or intent-to-add) have no blob hash; skip-worktree entries are left
+    out. Returns None for split or sparse indexes, which list only part of the tree.
+    """
+    import struct
+    
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b"DIRC":
+        return None
+    version, count = struct.unpack_from(">II", data, 4)
+    if version not in (2, 3, 4):
+        return None
+    
+    entries = {}
+    pos = 12
+    path = b""
+    for _ in range(count):
+        start = pos
+        mtime_s, mtime_ns, _, inode, mode, _, _, size = struct.unpack_from(">8I", data, pos + 8)
+        sha = data[pos + 40:pos + 60]
+        flags, = struct.unpack_from(">H", data, pos + 60)
+        extended = 0
+        pos += 62
+        if version >= 3 and flags & 0x4000:
+            extended, = struct.unpack_from(">H", data, pos)
+            pos += 2
+        
+        if version == 4:
+            # The path replaces the end of the previous one: a varint of bytes to drop, then the new suffix
+            byte = data[pos]
+            strip = byte & 0x7f
+            pos += 1
+            while byte & 0x80:
+                byte = data[pos]
+                strip = ((strip + 1) << 7) | (byte & 0x7f)
+                pos += 1
+            end = data.index(b"\0", pos)
+            path = path[:len(path) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            # NUL-padded to a multiple of 8 bytes
+            end = data.index(b"\0", pos)
+            path = data[pos:end]
+            pos = start + ((end - start) // 8 + 1) * 8
+        
+        if mode & 0o170000 == 0o040000:
+            return None  # A sparse index collapses whole directories into one entry
+        if mode & 0o170000 != 0o100000 or extended & 0x4000:
+            continue
+        vouched = (flags >> 12) & 3 == 0 and not extended & 0x2000
+        entries[os.fsdecode(path)] = (mtime_s, mtime_ns, size, inode, sha.hex() if vouched else None)
+    
+    # Extensions follow the entries; a split index keeps most entries in a shared file
+    while pos + 8 <= len(data) - 20:
+        signature, length = data[pos:pos + 4], struct.unpack_from(">I", data, pos + 4)[0]
+        if signature == b"link":
+            return None
+        pos += 8 + length
+    return entries
+
+def git_blob_hash(data: bytes) -> str:
+    """The object id git gives a file with these bytes"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def chunk_document(file_path: str, content: str, chunk_lines: int, chunk_overlap: int) -> List[Tuple[int, int]]:
+    """Split a cached document into (start, end) character spans for indexing.
+    
+    Python files are cut where top-level functions and classes (and methods of
+    top-level classes) start, and small neighbouring units are merged back together.
+    Other files, and any unit longer than chunk_lines, become overlapping line windows.
+    """
+    # Skip the "File: ..." header and its underline
+    body_start = content.find("\n", content.find("\n") + 1) + 1
+    lines = content[body_start:].splitlines(keepends=True)
+    offsets = [body_start]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    
+    cuts = python_cut_points(content[body_start:]) if file_path.endswith(".py") else None
+    cuts = sorted({0, len(lines)} | set(cuts or []))
+    
+    # Merge small neighbouring units, then window anything still too long
+    units = []
+    for start, end in zip(cuts, cuts[1:]):
+        if units and end - units[-1][0] <= chunk_lines:
+            units[-1] = (units[-1][0], end)
+        else:
+            units.append((start, end))
+    
+    step = chunk_lines - chunk_overlap
+    spans = []
+    for start, end in units:
+        while end - start > chunk_lines:
+            spans.append((offsets[start], offsets[start + chunk_lines]))
+            start += step
+        spans.append((offsets[start], offsets[end]))
+    
+    return spans
+
+def python_cut_points(source: str) -> Optional[List[int]]:
+    """0-based line numbers where top-level defs/classes and their methods begin"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+    
+    def first_line(node):
+        # Decorators belong to the definition they wrap
+        return min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])]) - 1
+    
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    cuts = []
+    for node in tree.body:
+        if isinstance(node, definitions):
+            cuts.append(first_line(node))
+        if isinstance(node, ast.ClassDef):
+            cuts.extend(first_line(child) for child in node.body if isinstance(child, definitions))
+    
+    return cuts
+
+IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+# Identifier pieces: "HTTPServer" -> HTTP, Server; "parse_json2" -> parse, json, 2
+SUBWORD_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+CODE_STOP_WORDS = frozenset("""
+    a an and are as at be but by can do for from has have if in into is it its no not of on or
+    so than that the then there these this those to was we were will with you your
+""".split())
+
+def code_tokenize(text: str) -> List[str]:
+    """Code-aware analyzer for the builtin retriever.
+    
+    Each identifier yields its camelCase/snake_case pieces, plus the whole identifier
+    when it has more than one, so "getUserKeys" matches both "user keys" and itself.
+    """
+    tokens = []
+    for identifier in IDENTIFIER_RE.findall(text):
+        parts = [part.lower() for part in SUBWORD_RE.findall(identifier)]
+        if len(parts) > 1:
+            tokens.append(identifier.lower())
+        tokens.extend(part for part in parts
+                      if len(part) > 1 and not part.isdigit() and part not in CODE_STOP_WORDS)
+    return tokens
+
+@lru_cache(maxsize=None)
+def get_analyzer(retriever: str = "sklearn"):
+    """The analyzer shared by documents and queries for the given retriever.
+    
+    It is stateless, so per-file vectors stay valid across queries; corpus-level pruning
+    (min_df/max_df) is applied to the persisted index instead.
+    """
+    if retriever == "builtin":
+        return code_tokenize
+    
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    
+    return TfidfVectorizer(stop_words='english', ngram_range=(1, 2)).build_analyzer()
+
+# Machine-written files that slip past the excludes: lockfiles by name, bundles by suffix,
+# the rest by a generated-code banner near the top or by minified line lengths
+GENERATED_FILE_NAMES = frozenset({
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml", "bun.lockb",
+    "Cargo.lock", "Gemfile.lock", "composer.lock", "poetry.lock", "Pipfile.lock", "go.sum"
+})
+GENERATED_FILE_SUFFIXES = (".min.js", ".min.css", ".bundle.js", ".map", ".pb.go", "_pb2.py")
+GENERATED_MARKER_RE = re.compile(r"@generated|do not edit|auto-?generated|code generated by", re.IGNORECASE)
+MINIFIED_LINE_LENGTH = 300
+
+def looks_generated(file_name: str, content: str) -> bool:
+    """Cheap check for lockfiles, minified bundles and generated code, which waste context"""
+    if file_name in GENERATED_FILE_NAMES or file_name.endswith(GENERATED_FILE_SUFFIXES):
+        return True
+    if GENERATED_MARKER_RE.search(content, 0, 1024):
+        return True
+    return len(content) > 4096 and len(content) / (content.count("\n") + 1) > MINIFIED_LINE_LENGTH
+
+# Files with fewer distinct terms get no signature: too little text to call two files near-copies
+# (exact copies are still caught by their content hash)
+SIMHASH_MIN_TERMS = 32
+
+def term_fingerprint(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def simhash(fingerprints: np.ndarray, weights: np.ndarray) -> Optional[int]:
+    """64-bit SimHash of a term-frequency vector (signed, to fit SQLite's INTEGER).
+    
+    Takes the term_fingerprint of each distinct term and the term's count. Files that
+    share most of their terms get signatures a few bits apart, so vendored copies and
+    lightly edited duplicates can be found without comparing their text.
+    """
+    if len(fingerprints) < SIMHASH_MIN_TERMS:
+        return None
+    
+    # A bit is set when the terms having it outweigh those that don't
+    bits = np.unpackbits(fingerprints.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    totals = np.asarray(weights, dtype=np.float64) @ bits
+    signature = int(np.packbits(2 * totals > np.sum(weights), bitorder='little').view('<u8')[0])
+    return signature - (1 << 64) if signature >= 1 << 63 else signature
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+# Pieces a BPE tokenizer rarely merges across, each counted once: non-ASCII characters,
+# runs of up to six letters (so long identifiers count once per six), digit groups,
+# punctuation pairs, and line breaks with their indentation. One alternation keeps this to a
+# single pass over the text. Calibrated against the GPT-4 tokenizer on source code and prose.
+TOKEN_ESTIMATE_RE = re.compile(r"[^\x00-\x7f]|[A-Za-z_]{1,6}|\d{1,3}|[^\w\s]{1,2}|\n[ \t]{2,}|\n")
+
+# Context window and token count relative to the estimator, by model name prefix (longest wins)
+MODEL_TOKEN_LIMITS = {
+    "gpt-4o": (128000, 0.9),
+    "gpt-4-turbo": (128000, 1.0),
+    "gpt-4": (8192, 1.0),
+    "gpt-3.5-turbo": (16385, 1.0),
+    "claude-": (200000, 1.15),
+    "gemini-1.5": (1048576, 1.05),
+    "gemini-pro": (32760, 1.05),
+}
+
+# Unknown models get a small window and a pessimistic ratio rather than an overflow
+DEFAULT_MODEL_TOKEN_LIMITS = (8192, 1.2)
+
+# Room left for the prompt template and each API's message framing
+PROMPT_OVERHEAD_TOKENS = 64
+
+def estimate_tokens(text: str) -> int:
+    """Fast estimate of the GPT-4 tokenizer's count for text, without loading a tokenizer"""
+    return len(TOKEN_ESTIMATE_RE.findall(text))
+
+def model_token_limits(model: str) -> Tuple[int, float]:
+    """(context window, token ratio to estimate_tokens) for a model name"""
+    prefixes = [prefix for prefix in MODEL_TOKEN_LIMITS if model.startswith(prefix)]
+    return MODEL_TOKEN_LIMITS[max(prefixes, key=len)] if prefixes else DEFAULT_MODEL_TOKEN_LIMITS
+
+def tokenize_document(task: Tuple[str, str, int, int, str]) -> Tuple[List[Tuple[int, int, int, int]], List[Counter]]:
+    """Chunk one document, count the terms of each chunk and estimate its tokens.
+    
+    Module-level so it can run in a worker process; takes
+    (file_path, content, chunk_lines, chunk_overlap, retriever).
+    """
+    file_path, content, chunk_lines, chunk_overlap, retriever = task
+    analyzer = get_analyzer(retriever)
+    spans = chunk_document(file_path, content, chunk_lines, chunk_overlap)
+    located = [location + (estimate_tokens(content[start:end]),)
+               for location, (start, end) in zip(locate_chunks(content, spans), spans)]
+    return located, [Counter(analyzer(content[start:end])) for start, end in spans]
+
+def locate_chunks(content: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int, int]]:
+    """Turn ascending character spans into (byte start, byte end, first line) within the UTF-8 text.
+    
+    Byte offsets let a chunk be sliced straight out of the corpus store, and the line
+    number (counted from below the file header) saves decoding the text in front of it.
+    """
+    body_start = content.find("\n", content.find("\n") + 1) + 1
+    ascii_only = content.isascii()
+    located = []
+    char_pos = byte_pos = 0
+    line_pos, line = body_start, 1
+    
+    for start, end in spans:
+        if start > line_pos:
+            line += content.count("\n", line_pos, start)
+            line_pos = start
+        if ascii_only:
+            byte_start, byte_end = start, end
+        else:
+            byte_start = byte_pos + len(content[char_pos:start].encode('utf-8'))
+            byte_end = byte_start + len(content[start:end].encode('utf-8'))
+            char_pos, byte_pos = start, byte_start
+        located.append((byte_start, byte_end, line))
+    
+    return located
+
+class CorpusStore:
+    """Append-only file of UTF-8 document texts, read back through a memory map.
+    
+    Texts are addressed by (offset, length) and never rewritten in place, so offsets
+    committed to the cache stay valid while other processes append. Compaction writes
+    a new file instead; a store that was already reading keeps its handle on the old one.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = None
+        self._read_fd = None
+        self._map = None
+        
+        # Opened up front so this store keeps reading the same file even if compaction replaces it
+        try:
+            self._read_fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            pass
+    
+    def size(self) -> int:
+        """Current length of the store in bytes"""
+        try:
+            return self.path.stat().st_size
+        except OSError:
+            return 0
+    
+    def append(self, data: bytes) -> int:
+        """Append one text and return its offset"""
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if self._read_fd is None:
+                self._read_fd = os.open(self.path, os.O_RDONLY)
+        
+        # One O_APPEND write per text, so concurrent writers can't interleave inside it
+        written = os.write(self._fd, data)
+        return os.lseek(self._fd, 0, os.SEEK_CUR) - written
+    
+    def sync(self):
+        """Flush appended texts to disk before their offsets are committed"""
+        if self._fd is not None:
+            os.fsync(self._fd)
+    
+    def read(self, offset: int, length: int) -> Optional[memoryview]:
+        """Zero-copy view of a stored text (or part of one), None if it lies past the end of the store"""
+        end = offset + length
+        if self._map is None or end > len(self._map):
+            # Texts appended since the map was made, by this or another process
+            try:
+                if self._read_fd is None:
+                    self._read_fd = os.open(self.path, os.O_RDONLY)
+                if end and os.fstat(self._read_fd).st_size >= end:
+                    self._map = mmap.mmap(self._read_fd, 0, access=mmap.ACCESS_READ)
+            except OSError:
+                return None
+            if self._map is None or end > len(self._map):
+                return None
+        return memoryview(self._map)[offset:end]
+    
+    def text(self, offset: int, length: int) -> Optional[str]:
+        """Decode a stored byte range"""
+        view = self.read(offset, length)
+        if view is None:
+            return None
+        with view:
+            return str(view, 'utf-8', errors='ignore')
+    
+    def close(self):
+        """Release the file handles and the map"""
+        for fd in (self._fd, self._read_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._read_fd = None
+        self._map = None
+    
+    __del__ = close
+
+class StoredCorpus(Mapping):
+    """Read-only {file path: text} view over texts in a CorpusStore.
+    
+    Only locations are held in memory; texts are decoded when looked up, and
+    chunk() decodes just one byte range. metadata carries each file's (mtime, size)
+    from the scan, for ranking without touching the filesystem again.
+    """
+    
+    def __init__(self, store: CorpusStore, locations: Dict[str, Tuple[int, int]],
+                 metadata: Dict[str, Tuple[float, int]] = None):
+        self.store = store
+        self.locations = locations
+        self.metadata = metadata or {}
+        self._newest = None
+    
+    @property
+    def newest(self) -> float:
+        """The most recent mtime in the corpus, the reference point for recency"""
+        if self._newest is None:
+            self._newest = max((self.metadata[path][0] for path in self.locations if path in self.metadata),
+                               default=0.0)
+        return self._newest
+    
+    def __getitem__(self, file_path: str) -> str:
+        return self.store.text(*self.locations[file_path]) or ""
+    
+    def __iter__(self):
+        return iter(self.locations)
+    
+    def __len__(self) -> int:
+        return len(self.locations)
+    
+    def chunk(self, file_path: str, start: int, end: int) -> str:
+        """Text of the byte range [start, end) of a document"""
+        offset, length = self.locations[file_path]
+        return self.store.text(offset + start, min(end, length) - start) or ""
+
+def cache_partition_dir(cache_root: Path, root_path: str) -> Path:
+    """Directory holding the cache partition for one project root"""
+    return cache_root / "projects" / hashlib.sha1(root_path.encode()).hexdigest()[:16]
+
+def directory_size(path: Path) -> int:
+    """Total size of the files below path"""
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                continue
+    return total
+
+def format_bytes(size: float) -> str:
+    """Human-readable byte count"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def parse_size(text: str) -> int:
+    """Parse a byte count such as 500000, 64K, 512M or 2G"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*", str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * 1024 ** " KMG".index(match.group(2).upper() or " "))
+
+def parse_weights(text: str) -> Dict[str, float]:
+    """Parse re-ranking weights such as recency=0.3,locality=0"""
+    weights = {}
+    for item in str(text).split(","):
+        name, sep, value = item.partition("=")
+        try:
+            weights[name.strip()] = float(value)
+        except ValueError:
+            raise ValueError(f"Invalid weight: {item.strip()} (expected name=number)") from None
+    return weights
+
+def partition_daemon(partition_dir: Path) -> Optional[int]:
+    """Pid of the running daemon serving a partition, from the pid file it keeps there, or None"""
+    try:
+        pid = int((partition_dir / "daemon.pid").read_text())
+        os.kill(pid, 0)
+    except PermissionError:
+        return pid  # Alive, but another user's
+    except (OSError, ValueError):
+        return None
+    return pid
+
+def cache_partitions(cache_root: Path) -> List[Dict[str, Any]]:
+    """Describe each project partition: dir, root, bytes, entries, last_accessed and daemon (pid or None).
+    
+    bytes counts live data only: free database pages are reused by later writes and
+    superseded texts are dropped when the corpus store is compacted, so neither is usage.
+    """
+    projects_dir = cache_root / "projects"
+    if not projects_dir.is_dir():
+        return []
+    
+    partitions = []
+    for entry in os.scandir(projects_dir):
+        db_path = Path(entry.path) / "project_memory.db"
+        if not entry.is_dir() or not db_path.exists():
+            continue
+        
+        meta, entries, dead_bytes = {}, 0, 0
+        try:
+            conn = sqlite3.connect(db_path, timeout=30)
+            try:
+                meta = dict(conn.execute('SELECT key, value FROM index_meta'))
+                entries = conn.execute('SELECT COUNT(*) FROM file_cache').fetchone()[0]
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+                live_texts = conn.execute('SELECT COALESCE(SUM(blob_length), 0) FROM file_cache').fetchone()[0]
+            finally:
+                conn.close()
+            corpus_path = Path(entry.path) / meta.get('corpus_file', 'corpus.bin')
+            corpus_size = corpus_path.stat().st_size if corpus_path.exists() else 0
+            dead_bytes = free_pages * page_size + max(corpus_size - live_texts, 0)
+        except (sqlite3.Error, OSError):
+            pass
+        
+        partitions.append({
+            'dir': Path(entry.path),
+            'root': meta.get('root_path'),
+            'bytes': max(directory_size(Path(entry.path)) - dead_bytes, 0),
+            'entries': entries,
+            'last_accessed': float(meta.get('last_accessed', 0)),
+            'daemon': partition_daemon(Path(entry.path))
+        })
+    
+    return partitions
+
+def compact_corpus_store(conn: sqlite3.Connection, cache_dir: Path) -> int:
+    """Rewrite a partition's corpus store with only the texts file_cache still points at.
+    
+    The copy gets a new name, recorded in index_meta in the same transaction as the new
+    offsets; readers that already opened the old file keep reading it. Returns the bytes freed.
+    """
+    new_name = f"corpus-{os.urandom(4).hex()}.bin"
+    new_path = cache_dir / new_name
+    
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT value FROM index_meta WHERE key = 'corpus_file'").fetchone()
+        old_path = cache_dir / (row[0] if row else 'corpus.bin')
+        old_store = CorpusStore(old_path)
+        old_size = old_store.size()
+        moved, lost = [], []
+        
+        try:
+            with open(new_path, 'wb') as out:
+                for file_path, offset, length in conn.execute(
+                    'SELECT file_path, blob_offset, blob_length FROM file_cache '
+                    'WHERE blob_offset IS NOT NULL ORDER BY blob_offset'
+                ).fetchall():
+                    view = old_store.read(offset, length)
+                    if view is None:
+                        lost.append((file_path,))
+                        continue
+                    with view:
+                        moved.append((out.tell(), file_path))
+                        out.write(view)
+                out.flush()
+                os.fsync(out.fileno())
+            
+            conn.executemany('UPDATE file_cache SET blob_offset = ? WHERE file_path = ?', moved)
+            # Rows whose text is gone are dropped, so those files are read again
+            conn.executemany('DELETE FROM file_cache WHERE file_path = ?', lost)
+            conn.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES ('corpus_file', ?)", (new_name,))
+        except BaseException:
+            new_path.unlink(missing_ok=True)
+            raise
+        finally:
+            old_store.close()
+    
+    old_path.unlink(missing_ok=True)
+    return old_size - new_path.stat().st_size
+
+def prune_cache(cache_root: Path, max_bytes: int = None, max_entries: int = None,
+                current: "ProjectMemory" = None, keep=()) -> List[str]:
+    """Bring the cache under its caps and return a description of what was done.
+    
+    Partitions of projects that no longer exist go first, then whole partitions in least
+    recently used order. Partitions in use are never removed: that of current (if given),
+    the partition directories in keep and those a running daemon is serving. If they
+    alone are over the caps, a warning is returned instead; evicting their entries
+    would only have them indexed again on the next scan.
+    """
+    import shutil
+    
+    actions = []
+    partitions = sorted(cache_partitions(cache_root), key=lambda partition: partition['last_accessed'])
+    kept = {current.cache_dir if current else None, *keep}
+    kept |= {partition['dir'] for partition in partitions if partition['daemon']}
+    
+    # The cache layout from before partitioning
+    legacy = [cache_root / name for name in ("project_memory.db", "project_memory.db-wal", "project_memory.db-shm",
+                                             "corpus.bin", "bm25")]
+    legacy_bytes = sum(directory_size(path) if path.is_dir() else path.stat().st_size
+                       for path in legacy if path.exists())
+    if legacy_bytes:
+        for path in legacy:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+        actions.append(f"Removed the shared pre-partition cache ({format_bytes(legacy_bytes)})")
+    
+    def remove(partition, reason):
+        shutil.rmtree(partition['dir'], ignore_errors=True)
+        partitions.remove(partition)
+        actions.append(f"Removed {partition['root'] or partition['dir'].name} "
+                       f"({reason}, {partition['entries']} entries, {format_bytes(partition['bytes'])})")
+    
+    def excess() -> Tuple[int, int]:
+        extra_bytes = sum(p['bytes'] for p in partitions) - max_bytes if max_bytes is not None else 0
+        extra_entries = sum(p['entries'] for p in partitions) - max_entries if max_entries is not None else 0
+        return max(extra_bytes, 0), max(extra_entries, 0)
+    
+    for partition in list(partitions):
+        if partition['dir'] not in kept and not (partition['root'] and os.path.isdir(partition['root'])):
+            remove(partition, "project no longer exists")
+    
+    for partition in list(partitions):
+        if not any(excess()):
+            break
+        if partition['dir'] not in kept:
+            remove(partition, "least recently used")
+    
+    if any(excess()):
+        caps = [format_bytes(max_bytes)] if max_bytes is not None else []
+        caps += [f"{max_entries} entries"] if max_entries is not None else []
+        in_use = ", ".join(str(p['root'] or p['dir'].name) for p in partitions)
+        actions.append(f"Warning: the projects in use are over the cache caps ({', '.join(caps)}) on their own "
+                       f"({format_bytes(sum(p['bytes'] for p in partitions))}, "
+                       f"{sum(p['entries'] for p in partitions)} entries): {in_use}. Raise cache_max_bytes or "
+                       f"cache_max_entries to stop this warning")
+    
+    return actions
+
+def join_snippets(snippets: List[str]) -> str:
+    """The project context block for a list of formatted snippets"""
+    if not snippets:
+        return "No files found in project."
+    return "\n" + "="*80 + "\n".join(snippets)
+
+def snippet_hash(snippet: str) -> str:
+    """Content address of a snippet, as the server verifies it"""
+    return hashlib.sha256(snippet.encode('utf-8')).hexdigest()
+
+def inline_context(request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """request_data with its context snippets folded into the prompt, as older servers expect"""
+    snippets = request_data.get("context_snippets")
+    if snippets is None:
+        return request_data
+    
+    context = join_snippets([snippets["content"][digest] for digest in snippets["order"]])
+    request_data = {key: value for key, value in request_data.items() if key != "context_snippets"}
+    request_data["prompt"] = f"Context from project:\n{context}\n\nPrompt: {request_data['prompt']}"
+    return request_data
+
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+# The server's caps on snippets sent by reference; context beyond them is inlined instead
+MAX_CONTEXT_SNIPPETS = 256
+MAX_SNIPPET_BYTES = 128 * 1024
+
+def compress_body(body: bytes, encodings: List[str]) -> Tuple[bytes, Optional[str]]:
+    """(body, Content-Encoding) compressed with the best encoding the server accepts.
+    
+    zstd needs the optional zstandard package; gzip is always available.
+    """
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    
+    if "zstd" in encodings:
+        try:
+            import zstandard
+        except ImportError:
+            pass
+        else:
+            return zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+    if "gzip" in encodings:
+        import gzip
+        return gzip.compress(body, compresslevel=6, mtime=0), "gzip"
+    return body, None
+
+class ResponseCache:
+    """Content-addressed cache of API responses, keyed on the normalized request body.
+    
+    Entries expire after a TTL (checked per lookup, so callers can ask for fresher
+    answers) and are evicted least recently used first once the cache outgrows
+    max_bytes. Safe to share between the batch worker threads.
+    """
+    
+    def __init__(self, path: Path, ttl: float, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_accessed ON responses (last_accessed)')
+    
+    @staticmethod
+    def request_key(api_url: str, request_data: Dict[str, Any]) -> str:
+        """SHA-256 of the request as the server would answer it.
+        
+        Project context is keyed by its snippet hashes, so a change to any selected
+        snippet changes the key however the body is later sent. BYO keys and the stream
+        flag don't change the answer and are left out.
+        """
+        normalized = {key: value for key, value in request_data.items() if key not in ("byo_keys", "stream")}
+        if "context_snippets" in normalized:
+            normalized["context_snippets"] = normalized["context_snippets"]["order"]
+        if isinstance(normalized.get("temperature"), (int, float)):
+            normalized["temperature"] = float(normalized["temperature"])
+        normalized["api_url"] = api_url
+        encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str, ttl: float = None) -> Optional[Dict[str, Any]]:
+        """The cached response for key if younger than ttl (default: the cache's TTL), else None"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < now - ttl:
+                return None
+            self.conn.execute('UPDATE responses SET last_accessed = ? WHERE key = ?', (now, key))
+        
+        response = json.loads(zlib.decompress(row[0]))
+        response["cached"] = True
+        return response
+    
+    def put(self, key: str, response: Dict[str, Any]):
+        """Store a response unless a model failed, then expire and evict down to the caps"""
+        if not response.get("responses") or any(resp.get("error") for resp in response["responses"]):
+            return
+        
+        # Client-measured stream timings describe that call, not the answer
+        response = dict(response, responses=[{k: v for k, v in resp.items() if k != "time_to_first_token_ms"}
+                                             for resp in response["responses"]])
+        response.pop("time_to_first_token_ms", None)
+        blob = zlib.compress(json.dumps(response).encode('utf-8'))
+        
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                              (key, blob, len(blob), now, now))
+            self.prune(now)
+    
+    def prune(self, now: float = None) -> int:
+        """Drop expired entries, then least recently used ones beyond max_bytes; returns how many went"""
+        now = now or time.time()
+        removed = self.conn.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,)).rowcount
+        
+        excess = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0] - self.max_bytes
+        if excess > 0:
+            evict = []
+            for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY last_accessed'):
+                if excess <= 0:
+                    break
+                evict.append((key,))
+                excess -= size
+            self.conn.executemany('DELETE FROM responses WHERE key = ?', evict)
+            removed += len(evict)
+        return removed
+    
+    def stats(self) -> Tuple[int, int]:
+        """(entries, bytes) currently stored"""
+        return self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+    
+    def close(self):
+        self.conn.close()
+
+class ServerState:
+    """What the CLI has learned about each API server, persisted between runs.
+    
+    Per api_url: the request encodings and features its responses advertise, and
+    which context snippets were uploaded to it and when, so later requests can refer
+    to them by hash. Uploads are trusted for most of the advertised snippet TTL; a
+    409 listing missing snippets corrects for anything the server dropped sooner.
+    """
+    
+    MAX_SNIPPETS = 4096
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(path) as f:
+                self.servers = json.load(f)
+        except (OSError, ValueError):
+            self.servers = {}
+    
+    def server(self, api_url: str) -> Dict[str, Any]:
+        return self.servers.setdefault(api_url, {"encodings": [], "features": [], "snippet_ttl": 0, "snippets": {}})
+    
+    def encodings(self, api_url: str) -> List[str]:
+        with self._lock:
+            return list(self.server(api_url)["encodings"])
+    
+    def known_snippets(self, api_url: str) -> Optional[set]:
+        """Hashes api_url should still hold, or None if it doesn't take snippets by reference"""
+        with self._lock:
+            server = self.server(api_url)
+            if "context-snippets" not in server["features"]:
+                return None
+            fresh_after = time.time() - 0.9 * server["snippet_ttl"]
+            return {digest for digest, uploaded_at in server["snippets"].items() if uploaded_at > fresh_after}
+    
+    def note_headers(self, api_url: str, headers: Mapping[str, str]):
+        """Update api_url's capabilities from a response's Accept-Encoding and X-Polydev-* headers"""
+        def items(name):
+            return sorted({item.strip().lower() for item in headers.get(name, "").split(",") if item.strip()})
+        
+        ttl = headers.get("X-Polydev-Snippet-TTL", "")
+        update = {
+            "encodings": items("Accept-Encoding"),
+            "features": items("X-Polydev-Features"),
+            "snippet_ttl": int(ttl) if ttl.isdigit() else 0
+        }
+        with self._lock:
+            server = self.server(api_url)
+            if any(server[key] != value for key, value in update.items()):
+                server.update(update)
+                self._dirty = True
+    
+    def drop_encoding(self, api_url: str, encoding: str):
+        with self._lock:
+            server = self.server(api_url)
+            server["encodings"] = [item for item in server["encodings"] if item != encoding]
+            self._dirty = True
+    
+    def record_snippets(self, api_url: str, hashes: List[str]):
+        """Note hashes as uploaded to api_url now, keeping the newest MAX_SNIPPETS"""
+        if not hashes:
+            return
+        now = time.time()
+        with self._lock:
+            snippets = self.server(api_url)["snippets"]
+            snippets.update(dict.fromkeys(hashes, now))
+            if len(snippets) > self.MAX_SNIPPETS:
+                newest = sorted(snippets.items(), key=lambda item: item[1])[-self.MAX_SNIPPETS:]
+                snippets.clear()
+                snippets.update(newest)
+            self._dirty = True
+    
+    def forget_snippets(self, api_url: str, hashes: List[str]):
+        with self._lock:
+            snippets = self.server(api_url)["snippets"]
+            for digest in hashes:
+                snippets.pop(digest, None)
+            self._dirty = True
+    
+    def save(self):
+        """Write the state if it changed, atomically so concurrent CLIs never read half a file"""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(self.servers, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+def pack_chunks(candidates, k: int, budget_chars: int, budget_tokens: int = None,
+                token_ratio: float = 1.0) -> List[str]:
+    """Pack ranked chunks greedily into budget_chars, drawing from at most k distinct files.
+    
+    candidates yields (memory, corpus, file path, span, similarity) best first, where memory
+    is the ProjectMemory that scored the chunk. Given budget_tokens, the budget is counted
+    in tokens instead, using each chunk's estimate from indexing scaled by token_ratio.
+    """
+    # Best chunks first, skipping ones that overlap an earlier pick or no longer fit, so
+    # one large file can't crowd out everything else. Files that are near-copies of one
+    # already picked are passed over entirely.
+    result_parts = []
+    budget = budget_chars if budget_tokens is None else budget_tokens
+    used = 0
+    selected_spans = {}
+    selected_signatures = {}
+    duplicates = set()
+    
+    with timings.span("pack chunks"):
+        for memory, corpus, file_path, span, similarity_score in candidates:
+            if budget - used <= 0:
+                break
+            
+            if file_path not in selected_spans:
+                if len(selected_spans) >= k or file_path in duplicates:
+                    continue
+                signature = memory.file_signature(file_path)
+                if memory.is_near_duplicate(signature, selected_signatures.values()):
+                    duplicates.add(file_path)
+                    continue
+            
+            start, end = int(span[0]), int(span[1])
+            if any(start < taken_end and taken_start < end for taken_start, taken_end in selected_spans.get(file_path, [])):
+                continue
+            
+            # Only the winning chunk's bytes are decoded, straight from the store
+            text = corpus.chunk(file_path, start, end)
+            label = f"Similarity: {similarity_score:.3f}\n"
+            chunk = memory.format_chunk(file_path, text, int(span[2]))
+            if budget_tokens is None:
+                cost = len(chunk)
+            else:
+                # The text's estimate was stored at indexing time; only the headers are counted here
+                header_tokens = estimate_tokens(label + chunk[:len(chunk) - len(text) - 1])
+                cost = math.ceil((int(span[3]) + header_tokens) * token_ratio)
+            
+            if used + cost > budget:
+                if result_parts:
+                    continue
+                # Nothing fits yet: keep the best chunk, truncated, rather than return nothing
+                chunk = chunk[:len(chunk) * (budget - used) // cost] + "... [truncated]"
+                cost = budget - used
+            
+            result_parts.append(label + chunk)
+            used += cost
+            if file_path not in selected_spans:
+                selected_signatures[file_path] = signature
+            selected_spans.setdefault(file_path, []).append((start, end))
+    timings.count("near-duplicates collapsed", len(duplicates))
+    
+    return result_parts
+
+def pack_files(candidates, k: int, budget_chars: int, budget_tokens: int = None,
+               token_ratio: float = 1.0) -> List[str]:
+    """Pack up to k whole files into the budget, truncating the last; see pack_chunks.
+    
+    candidates yields (memory, corpus, file path) best first.
+    """
+    result_parts = []
+    budget = budget_chars if budget_tokens is None else budget_tokens
+    used = 0
+    selected_signatures = []
+    
+    for memory, corpus, file_path in candidates:
+        if used >= budget or len(result_parts) >= k:
+            break
+        signature = memory.file_signature(file_path)
+        if memory.is_near_duplicate(signature, selected_signatures):
+            continue
+        selected_signatures.append(signature)
+        
+        content = corpus[file_path]
+        cost = len(content) if budget_tokens is None else math.ceil(estimate_tokens(content) * token_ratio)
+        remaining_budget = budget - used
+        if cost > remaining_budget:
+            content = content[:len(content) * remaining_budget // cost] + "... [truncated]"
+            cost = remaining_budget
+        
+        result_parts.append(content)
+        used += cost
+    
+    return result_parts
 
 class ProjectMemory:
     """Handles local project memory with TF-IDF based snippet selection"""
     
-    def __init__(self, root_path: str, cache_dir: str = None):
+    # Bump whenever the analyzer or the vector encoding changes so cached vectors are rebuilt
+    INDEX_VERSION = 5
+    
+    # Files whose SimHash signatures differ in at most this many bits count as copies
+    NEAR_DUPLICATE_BITS = 3
+    
+    # Re-ranking boosts a file's chunk scores by 1 + the weighted sum of these signals, each
+    # in [0, 1]: recency relative to the newest file (halving every RECENCY_HALF_LIFE
+    # seconds), directory overlap with the working directory, and smallness (half at
+    # SIZE_REFERENCE bytes). A weight of 0 turns a signal off.
+    RERANK_WEIGHTS = {"recency": 0.2, "locality": 0.2, "size": 0.1}
+    RECENCY_HALF_LIFE = 14 * 24 * 3600
+    SIZE_REFERENCE = 32 * 1024
+    
+    # The partition's last_accessed stamp is only refreshed when older than this, so warm queries don't write
+    ACCESS_RESOLUTION = 600
+    
+    # Compact the corpus store once superseded texts outweigh live ones by this much
+    COMPACT_SLACK_BYTES = 16 * 1024 * 1024
+    
+    # Changed files are stored and vectorized this many at a time, bounding the text held in memory
+    INDEX_BATCH_SIZE = 256
+    
+    RETRIEVERS = ("sklearn", "builtin")
+    
+    SCANNERS = ("walk", "git")
+    
+    def __init__(self, root_path: str, cache_dir: str = None, respect_gitignore: bool = False,
+                 jobs: int = None, processes: int = 0, retriever: str = "sklearn",
+                 max_cache_bytes: int = None, max_cache_entries: int = None, scanner: str = "walk"):
+        if retriever not in self.RETRIEVERS:
+            raise ValueError(f"Unknown retriever '{retriever}' (expected one of: {', '.join(self.RETRIEVERS)})")
+        if scanner not in self.SCANNERS:
+            raise ValueError(f"Unknown scanner '{scanner}' (expected one of: {', '.join(self.SCANNERS)})")
+        
         self.root_path = Path(root_path).resolve()
-        self.cache_dir = Path(cache_dir or os.path.expanduser("~/.polydev/cache"))
+        self.respect_gitignore = respect_gitignore
+        
+        # "walk": list files with scandir, hashing contents with SHA-256;
+        # "git": list them from the git index and `git ls-files`, hashing as git blobs so the
+        # index's own hashes can stand in for files whose stat it has already checked
+        self.scanner = scanner
+        
+        # "sklearn": TF-IDF cosine over scikit-learn's word analyzer;
+        # "builtin": BM25 over a code-aware tokenizer, with no scikit-learn import
+        self.retriever = retriever
+        
+        # Threads read and hash changed files; processes (if any) tokenize them
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+        self.processes = processes
+        
+        # Each project root gets its own partition: database, corpus store and BM25 matrices
+        self.cache_root = Path(cache_dir or os.path.expanduser("~/.polydev/cache"))
+        self.cache_dir = cache_partition_dir(self.cache_root, str(self.root_path))
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         
+        # Shared across partitions and enforced after scans that grow the cache; None means no cap.
+        # The caps never remove this partition or pinned ones (a workspace pins its other roots')
+        self.max_cache_bytes = max_cache_bytes
+        self.max_cache_entries = max_cache_entries
+        self.pinned_partitions = ()
+        
+        # Chunk headers show paths relative to this; a workspace uses its roots' common parent
+        self.label_root = self.root_path
+        
         # Initialize SQLite database for caching
         self.db_path = self.cache_dir / "project_memory.db"
-        self.init_database()
+        with timings.span("open cache"):
+            self.conn = self.connect()
+            self.init_database()
+        
+        # term -> id, loaded on first use by load_vocabulary; _vocabulary_max_id is the highest id in it
+        self._vocabulary = None
+        self._vocabulary_max_id = 0
+        
+        # term_fingerprint by term id, for the ids whose flag is set; see term_fingerprints
+        self._fingerprints = None
+        self._fingerprinted = None
         
         # Default file patterns
         self.default_includes = [
@@ -41,230 +1377,1569 @@ class ProjectMemory:
             ".git/**", ".next/**", "dist/**", "build/**", "target/**",
             "*.pyc", "*.pyo", "*.so", "*.dll", "*.exe", "*.o", "*.obj"
         ]
+        
+        with timings.span("load analyzer"):
+            self.analyzer = get_analyzer(retriever)
+        self.min_df = 2
+        self.max_df = 0.8
+        self.bm25_k1 = 1.2
+        self.bm25_b = 0.75
+        
+        # Retrieval unit size: Python is cut at def/class boundaries, everything else into
+        # overlapping line windows; units longer than chunk_lines are windowed as well
+        self.chunk_lines = 60
+        self.chunk_overlap = 10
+    
+    def connect(self) -> sqlite3.Connection:
+        """Open the long-lived cache connection.
+        
+        WAL lets other CLI invocations keep reading while this one writes, and the busy
+        timeout makes concurrent writers wait for each other instead of failing.
+        """
+        # A workspace prepares its roots on worker threads; each connection is still only
+        # used by one thread at a time
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')  # WAL stays consistent; only the last commits are at risk on power loss
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -65536')  # 64 MiB page cache
+        conn.execute('PRAGMA mmap_size = 268435456')
+        return conn
+    
+    def close(self):
+        """Close the cache connection and the corpus store"""
+        self.conn.close()
+        self.corpus_store.close()
     
     def init_database(self):
-        """Initialize SQLite database for caching file content and TF-IDF vectors"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Initialize SQLite database for caching file metadata and TF-IDF vectors.
+        
+        File text lives in the corpus store; file_cache rows only point into it.
+        """
+        with self.conn as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS index_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+            meta = dict(conn.execute('SELECT key, value FROM index_meta'))
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS file_cache (
                     file_path TEXT PRIMARY KEY,
                     content_hash TEXT NOT NULL,
-                    content TEXT NOT NULL,
+                    blob_offset INTEGER,
+                    blob_length INTEGER NOT NULL DEFAULT 0,
                     tfidf_vector TEXT,
                     last_modified REAL NOT NULL,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER,
+                    last_accessed REAL NOT NULL DEFAULT 0,
+                    simhash INTEGER,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_last_modified ON file_cache(last_modified)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_last_accessed ON file_cache(last_accessed)')
+            
+            # Added in index version 5; the vectors reset below backfills it as files are re-vectorized
+            if 'simhash' not in {row[1] for row in conn.execute('PRAGMA table_info(file_cache)')}:
+                conn.execute('ALTER TABLE file_cache ADD COLUMN simhash INTEGER')
+            
+            if version != self.INDEX_VERSION or meta.get('retriever', 'sklearn') != self.retriever:
+                # Vectors built by another analyzer or chunker don't match the current index
+                conn.execute('UPDATE file_cache SET tfidf_vector = NULL')
+                conn.execute('DROP TABLE IF EXISTS tfidf_docs')
+                conn.execute('DROP TABLE IF EXISTS tfidf_index')
+                conn.execute('DROP TABLE IF EXISTS tfidf_vocab')
+                conn.execute(f'PRAGMA user_version = {self.INDEX_VERSION}')
+                
+                # Term ids are reassigned from scratch, so matrices saved under the old ones are stale
+                reset = {'retriever': self.retriever, 'generation': os.urandom(8).hex()}
+                conn.executemany('INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)', reset.items())
+                meta.update(reset)
+            
+            if 'root_path' not in meta:
+                conn.execute("INSERT INTO index_meta (key, value) VALUES ('root_path', ?)", (str(self.root_path),))
+            self.partition_accessed = float(meta.get('last_accessed', 0))
+            
+            self.index_generation = meta.get('generation', '')
+            self.corpus_store = CorpusStore(self.cache_dir / meta.get('corpus_file', 'corpus.bin'))
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tfidf_vocab (
+                    term_id INTEGER PRIMARY KEY,
+                    term TEXT NOT NULL UNIQUE
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tfidf_index (
+                    root_path TEXT PRIMARY KEY,
+                    doc_count INTEGER NOT NULL,
+                    df BLOB NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tfidf_docs (
+                    root_path TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    chunk_count INTEGER NOT NULL,
+                    term_counts BLOB NOT NULL,
+                    PRIMARY KEY (root_path, file_path)
+                )
+            ''')
     
-    def get_file_hash(self, file_path: Path) -> str:
-        """Get SHA-256 hash of file content"""
-        try:
-            with open(file_path, 'rb') as f:
-                return hashlib.sha256(f.read()).hexdigest()
-        except Exception:
-            return ""
+    def record_access(self):
+        """Stamp the partition as used, for LRU eviction across projects (at most every ACCESS_RESOLUTION)"""
+        now = time.time()
+        if self.partition_accessed < now - self.ACCESS_RESOLUTION:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES ('last_accessed', ?)", (str(now),))
+            self.partition_accessed = now
+    
+    def refresh_corpus_store(self) -> bool:
+        """Follow the corpus store to a new file after compaction; returns True if it moved"""
+        row = self.conn.execute("SELECT value FROM index_meta WHERE key = 'corpus_file'").fetchone()
+        path = self.cache_dir / (row[0] if row else 'corpus.bin')
+        if path == self.corpus_store.path:
+            return False
+        
+        # The old store isn't closed: corpora handed out earlier still read through it
+        self.corpus_store = CorpusStore(path)
+        return True
+    
+    def hash_content(self, data: bytes) -> str:
+        """SHA-256 of data, or its git blob id with the git scanner"""
+        return git_blob_hash(data) if self.scanner == "git" else hashlib.sha256(data).hexdigest()
     
     def should_include_file(self, file_path: Path, includes: List[str], excludes: List[str]) -> bool:
         """Check if file should be included based on patterns"""
+        matcher = compile_matcher(tuple(includes), tuple(excludes))
         relative_path = file_path.relative_to(self.root_path)
-        path_str = str(relative_path)
         
-        # Check excludes first
-        for pattern in excludes:
-            if relative_path.match(pattern):
-                return False
+        # A file under a pruned directory is excluded even if its own path doesn't match
+        parents = [parent.as_posix() for parent in relative_path.parents][:-1]
+        if any(matcher.prune_dir(parent) for parent in parents):
+            return False
+        
+        return matcher.match_file(relative_path.as_posix())
+    
+    def walk_project(self, matcher: PathMatcher) -> Iterator[Tuple[os.DirEntry, str]]:
+        """Yield (entry, relative path) for included files, pruning excluded directories.
+        
+        Symlinked directories are not followed, which also keeps the walk free of cycles.
+        """
+        stack = [(str(self.root_path), "", [])]
+        
+        while stack:
+            dir_path, rel_dir, rules = stack.pop()
+            
+            if self.respect_gitignore:
+                gitignore = os.path.join(dir_path, ".gitignore")
+                if os.path.isfile(gitignore):
+                    rules = rules + parse_gitignore(gitignore, rel_dir)
+            
+            try:
+                entries = os.scandir(dir_path)
+            except OSError:
+                continue
+            
+            with entries:
+                for entry in entries:
+                    rel_path = rel_dir + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if matcher.prune_dir(rel_path):
+                                continue
+                            if self.respect_gitignore and (entry.name == ".git" or is_gitignored(rules, rel_path, True)):
+                                continue
+                            stack.append((entry.path, rel_path + "/", rules))
+                        elif entry.is_file() and matcher.match_file(rel_path):
+                            if self.respect_gitignore and is_gitignored(rules, rel_path, False):
+                                continue
+                            yield entry, rel_path
+                    except OSError:
+                        continue
+    
+    def stat_paths(self, matcher: PathMatcher, rel_paths: List[str]) -> List[Tuple[str, str, os.stat_result, None]]:
+        """(path, relative path, stat, None) for those of rel_paths that walk_project would yield.
+        
+        Only the given files and the directories above them are looked at, so the cost
+        follows the number of paths, not the size of the project.
+        """
+        rules_by_dir = {}
+        def dir_rules(rel_dir):
+            # The gitignore rules in force inside rel_dir ("" or ending in "/"), None if the walk prunes it
+            if rel_dir not in rules_by_dir:
+                rules = []
+                if rel_dir:
+                    parent, _, name = rel_dir[:-1].rpartition("/")
+                    rules = dir_rules(parent + "/" if parent else "")
+                    if rules is not None and (matcher.prune_dir(rel_dir[:-1]) or self.respect_gitignore and (
+                            name == ".git" or is_gitignored(rules, rel_dir[:-1], True))):
+                        rules = None
+                gitignore = os.path.join(self.root_path, rel_dir, ".gitignore")
+                if rules is not None and self.respect_gitignore and os.path.isfile(gitignore):
+                    rules = rules + parse_gitignore(gitignore, rel_dir)
+                rules_by_dir[rel_dir] = rules
+            return rules_by_dir[rel_dir]
+        
+        entries = []
+        for rel_path in rel_paths:
+            rel_dir = rel_path.rpartition("/")[0]
+            rules = dir_rules(rel_dir + "/" if rel_dir else "")
+            if rules is None or not matcher.match_file(rel_path):
+                continue
+            if self.respect_gitignore and is_gitignored(rules, rel_path, False):
+                continue
+            path = os.path.join(self.root_path, rel_path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mode & 0o170000 == 0o100000:
+                entries.append((path, rel_path, stat, None))
+        return entries
+    
+    def list_git_files(self, matcher: PathMatcher,
+                       paths: List[str] = None) -> Optional[List[Tuple[str, str, os.stat_result, Optional[str]]]]:
+        """(path, relative path, stat, blob hash or None) for included files of the git checkout.
+        
+        Tracked files come straight from the index. Where a file's stat still matches its
+        index entry, the entry's blob id is its content hash and it needs no hashing here.
+        Untracked files that git doesn't ignore come from `git ls-files`. Given paths
+        (relative to root_path), only those files are listed. None when root_path isn't
+        in a checkout this can read, so the caller can walk instead.
+        """
+        found = find_git_checkout(self.root_path)
+        if found is None:
+            return None
+        top, git_dir = found
+        
+        try:
+            if not git_uses_sha1(git_dir):
+                return None
+            index_stat = (git_dir / "index").stat()
+            index = read_git_index(git_dir / "index")
+            pathspecs = ["--"] + [f":(literal){path}" for path in paths] if paths is not None else []
+            untracked = subprocess.run(["git", "ls-files", "-z", "--others", "--exclude-standard"] + pathspecs,
+                                       cwd=self.root_path, capture_output=True, check=True).stdout
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return None
+        if index is None:
+            return None
+        
+        prefix = self.root_path.relative_to(top).as_posix()
+        prefix = "" if prefix == "." else prefix + "/"
+        candidates = [(path[len(prefix):], entry) for path, entry in index.items() if path.startswith(prefix)]
+        if paths is not None:
+            wanted = set(paths)
+            candidates = [(rel_path, entry) for rel_path, entry in candidates if rel_path in wanted]
+        candidates += [(os.fsdecode(path), None) for path in untracked.split(b"\0") if path]
+        
+        pruned = {"": False}
+        def dir_pruned(rel_dir):
+            if rel_dir not in pruned:
+                pruned[rel_dir] = dir_pruned(rel_dir.rpartition("/")[0]) or matcher.prune_dir(rel_dir)
+            return pruned[rel_dir]
+        
+        files = []
+        for rel_path, entry in candidates:
+            if dir_pruned(rel_path.rpartition("/")[0]) or not matcher.match_file(rel_path):
+                continue
+            path = os.path.join(self.root_path, rel_path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Deleted in the worktree but not yet in the index
+            if stat.st_mode & 0o170000 != 0o100000:
+                continue
+            
+            blob = None
+            if entry is not None and entry[4] is not None:
+                mtime_s, mtime_ns, size, inode, sha = entry
+                # The index stores 32-bit sizes and inodes, and zero where it doesn't track a field.
+                # Files modified no earlier than the index itself are "racily clean": an edit in
+                # the same timestamp tick wouldn't show in the stat, so they are hashed instead.
+                if (stat.st_mtime_ns // 10 ** 9 == mtime_s and mtime_ns in (0, stat.st_mtime_ns % 10 ** 9)
+                        and size == stat.st_size & 0xFFFFFFFF and inode in (0, stat.st_ino & 0xFFFFFFFF)
+                        and stat.st_mtime_ns < index_stat.st_mtime_ns):
+                    blob = sha
+            files.append((path, rel_path, stat, blob))
+        return files
+    
+    def extract_file_content(self, file_path: Path, max_size: int = 100000) -> str:
+        """Extract readable content from file"""
+        return self.read_file(file_path, max_size)[1]
+    
+    def read_file(self, file_path: Path, max_size: int = 100000) -> Tuple[str, str]:
+        """Read a file once and derive both its content hash and its readable content from the bytes"""
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except Exception as e:
+            return "", f"[Error reading {file_path.name}: {str(e)}]"
+        
+        content_hash = self.hash_content(data)
+        if len(data) > max_size:
+            return content_hash, f"[File too large: {file_path.name}]"
+        
+        # Same newline handling as reading in text mode
+        content = data.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+        
+        # Add file header for context
+        relative_path = file_path.relative_to(self.root_path)
+        return content_hash, f"File: {relative_path}\n{'='*50}\n{content}\n\n"
+    
+    def read_files(self, file_paths: List[Path]) -> List[Tuple[str, str]]:
+        """read_file over many files on the I/O thread pool, preserving order"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        if self.jobs <= 1 or len(file_paths) <= 1:
+            return [self.read_file(file_path) for file_path in file_paths]
+        
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(self.read_file, file_paths))
+    
+    def scan_project_files(self, includes: List[str] = None, excludes: List[str] = None,
+                           paths: List[str] = None) -> List[Dict[str, Any]]:
+        """Scan project files and return list with metadata.
+        
+        Given paths (relative to the root), only those files are considered and the project
+        isn't walked.
+        """
+        includes = includes or self.default_includes
+        excludes = excludes or self.default_excludes
+        
+        matcher = compile_matcher(tuple(includes), tuple(excludes))
+        entries = None
+        
+        if self.scanner == "git":
+            with timings.span("read git index"):
+                entries = self.list_git_files(matcher, paths)
+            if entries is None:
+                print(f"{self.root_path} is not in a readable git checkout; walking it instead", file=sys.stderr)
+        
+        if entries is None and paths is not None:
+            with timings.span("stat"):
+                entries = self.stat_paths(matcher, paths)
+        elif entries is None:
+            entries = []
+            with timings.span("walk"):
+                for entry, rel_path in self.walk_project(matcher):
+                    try:
+                        entries.append((entry.path, rel_path, entry.stat(), None))
+                    except OSError:
+                        continue
+        timings.count("files walked", len(entries))
+        
+        # Files whose (size, mtime_ns, inode) still match the cache keep their cached hash
+        # and are never opened; only the rest are read and hashed
+        with timings.span("stat cache lookup"):
+            cached = self.get_cached_rows([path for path, _, _, _ in entries], 'content_hash, size, mtime_ns, inode')
+        files = []
+        
+        for path, rel_path, stat, index_hash in entries:
+            row = cached.get(path)
+            unchanged = row is not None and row[1:] == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            
+            files.append({
+                'path': Path(path),
+                'relative_path': Path(rel_path),
+                'size': stat.st_size,
+                'modified': stat.st_mtime,
+                'mtime_ns': stat.st_mtime_ns,
+                'inode': stat.st_ino,
+                'hash': row[0] if unchanged else index_hash,
+                'unchanged': unchanged
+            })
+        
+        # Each changed file is read exactly once; the decoded content rides along so
+        # build_corpus doesn't have to open it again. Files the git index vouches for
+        # already have a hash, and are only read if it differs from the cached one
+        # (after a checkout, that is just the files in the diff).
+        changed = [file_info for file_info in files if not file_info['unchanged']]
+        unhashed = [file_info for file_info in changed if file_info['hash'] is None]
+        timings.count("stat cache hits", len(files) - len(changed))
+        timings.count("stat cache misses", len(changed))
+        timings.count("git index hashes", len(changed) - len(unhashed))
+        timings.count("bytes read", sum(file_info['size'] for file_info in unhashed))
+        
+        with timings.span("read and hash"):
+            contents = self.read_files([f['path'] for f in unhashed])
+        for file_info, (content_hash, content) in zip(unhashed, contents):
+            file_info['hash'] = content_hash
+            file_info['content'] = content
+        
+        return files
+    
+    def get_cached_rows(self, file_paths: List[str], columns: str) -> Dict[str, tuple]:
+        """Fetch the given file_cache columns for many paths at once, keyed by path"""
+        rows = {}
+        for start in range(0, len(file_paths), SQLITE_BATCH_SIZE):
+            batch = file_paths[start:start + SQLITE_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor = self.conn.execute(
+                f'SELECT file_path, {columns} FROM file_cache WHERE file_path IN ({placeholders})', batch
+            )
+            for row in cursor:
+                rows[row[0]] = row[1:]
+        
+        return rows
+    
+    def cache_contents(self, rows: List[tuple]):
+        """Write many file_cache rows with one prepared statement.
+        
+        Rows are (file_path, content_hash, blob_offset, blob_length, tfidf_vector, last_modified,
+        size, mtime_ns, inode, last_accessed, simhash), the blob already being in the corpus store.
+        The caller owns the transaction, so a whole scan commits (and syncs) once.
+        """
+        self.conn.executemany('''
+            INSERT OR REPLACE INTO file_cache 
+            (file_path, content_hash, blob_offset, blob_length, tfidf_vector, last_modified, size, mtime_ns, inode,
+             last_accessed, simhash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    
+    @staticmethod
+    def encode_vector(term_ids: np.ndarray, counts: np.ndarray) -> bytes:
+        """Pack a sparse term-frequency vector as uint32 term ids followed by their counts"""
+        return np.concatenate([term_ids, counts]).astype('<u4').tobytes()
+    
+    @staticmethod
+    def decode_vector(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """Unpack a vector produced by encode_vector into (term_ids, counts)"""
+        values = np.frombuffer(blob, dtype='<u4')
+        half = len(values) // 2
+        return values[:half], values[half:]
+    
+    @staticmethod
+    def encode_chunks(spans: List[Tuple[int, int, int, int]], vectors: List[Tuple[np.ndarray, np.ndarray]]) -> bytes:
+        """Pack a file's chunk vectors into one blob.
+        
+        Layout (uint32): chunk count, then (byte start, byte end, first line, estimated tokens, nnz)
+        per chunk, then all term ids, then all counts, so decoding is a couple of slices rather
+        than a loop.
+        """
+        header = [len(spans)]
+        for (start, end, line, tokens), (term_ids, _) in zip(spans, vectors):
+            header.extend((start, end, line, tokens, len(term_ids)))
+        
+        empty = np.zeros(0, dtype=np.uint32)
+        return np.concatenate(
+            [np.array(header, dtype=np.uint32)] +
+            [term_ids for term_ids, _ in vectors] + [empty] +
+            [counts for _, counts in vectors] + [empty]
+        ).astype('<u4').tobytes()
+    
+    @staticmethod
+    def decode_chunks(blob: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Unpack encode_chunks output into ((start, end, line, tokens) spans, nnz per chunk, term_ids, counts)"""
+        values = np.frombuffer(blob, dtype='<u4')
+        if not len(values):
+            empty = np.zeros(0, dtype=np.uint32)
+            return np.zeros((0, 4), dtype=np.uint32), empty, empty, empty
+        
+        n_chunks = int(values[0])
+        header = values[1:1 + 5 * n_chunks].reshape(n_chunks, 5)
+        body = values[1 + 5 * n_chunks:]
+        half = len(body) // 2
+        return header[:, :4], header[:, 4], body[:half], body[half:]
+    
+    def chunk_document(self, file_path: str, content: str) -> List[Tuple[int, int]]:
+        """Split a cached document into (start, end) character spans for indexing"""
+        return chunk_document(file_path, content, self.chunk_lines, self.chunk_overlap)
+    
+    def load_vocabulary(self) -> Dict[str, int]:
+        """The partition's term -> id dict, read once and then kept in memory.
+        
+        Called with the write lock held: ids other processes assigned since the last call
+        are read in, and the vocabulary is reloaded whole if it shrank underneath this one
+        (reset by another process, or ids assigned here were rolled back).
+        """
+        max_id = self.conn.execute('SELECT MAX(term_id) FROM tfidf_vocab').fetchone()[0] or 0
+        if self._vocabulary is None or max_id < self._vocabulary_max_id:
+            self._vocabulary = dict(self.conn.execute('SELECT term, term_id FROM tfidf_vocab'))
+            # Ids may now stand for other terms
+            self._fingerprints = None
+            self._fingerprinted = None
+        elif max_id > self._vocabulary_max_id:
+            self._vocabulary.update(self.conn.execute('SELECT term, term_id FROM tfidf_vocab WHERE term_id > ?',
+                                                      (self._vocabulary_max_id,)))
+        self._vocabulary_max_id = max_id
+        return self._vocabulary
+    
+    @contextmanager
+    def vocabulary_transaction(self):
+        """Forget the in-memory vocabulary if the enclosed transaction fails, rolling back ids assigned in it"""
+        try:
+            yield
+        except BaseException:
+            self._vocabulary = None
+            raise
+    
+    def get_term_ids(self, terms, create: bool = True) -> Dict[str, int]:
+        """Look up vocabulary ids for terms, assigning ids to unseen terms if requested.
+        
+        Assigning ids needs the write lock held (inside vocabulary_transaction): only terms
+        the in-memory vocabulary lacks are written, with ids numbered on from the highest.
+        Plain lookups use the in-memory vocabulary when it is loaded and query just the
+        given terms otherwise, so a warm query doesn't read the whole vocabulary.
+        """
+        if create:
+            vocabulary = self.load_vocabulary()
+            # Sorted, so the inserts walk the term index in order instead of at random
+            unseen = sorted({term for term in terms if term not in vocabulary})
+            if unseen:
+                first_id = self._vocabulary_max_id + 1
+                new_ids = dict(zip(unseen, range(first_id, first_id + len(unseen))))
+                self.conn.executemany('INSERT INTO tfidf_vocab (term, term_id) VALUES (?, ?)', new_ids.items())
+                vocabulary.update(new_ids)
+                self._vocabulary_max_id += len(unseen)
+            return {term: vocabulary[term] for term in terms}
+        
+        if self._vocabulary is not None:
+            return {term: self._vocabulary[term] for term in terms if term in self._vocabulary}
+        
+        terms = list(terms)
+        term_ids = {}
+        for start in range(0, len(terms), SQLITE_BATCH_SIZE):
+            batch = terms[start:start + SQLITE_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor = self.conn.execute(f'SELECT term, term_id FROM tfidf_vocab WHERE term IN ({placeholders})', batch)
+            term_ids.update(cursor.fetchall())
+        
+        return term_ids
+    
+    def term_fingerprints(self, term_ids: Dict[str, int]) -> np.ndarray:
+        """term_fingerprint by term id, covering term_ids; each term is hashed once per vocabulary"""
+        if self._fingerprints is None:
+            self._fingerprints = np.zeros(0, dtype=np.uint64)
+            self._fingerprinted = np.zeros(0, dtype=bool)
+        
+        size = max(term_ids.values(), default=0) + 1
+        if len(self._fingerprints) < size:
+            size = max(size, 2 * len(self._fingerprints))
+            self._fingerprints = np.concatenate([self._fingerprints,
+                                                 np.zeros(size - len(self._fingerprints), dtype=np.uint64)])
+            self._fingerprinted = np.concatenate([self._fingerprinted,
+                                                  np.zeros(size - len(self._fingerprinted), dtype=bool)])
+        
+        ids = np.fromiter(term_ids.values(), dtype=np.int64, count=len(term_ids))
+        missing = ~self._fingerprinted[ids]
+        if missing.any():
+            terms = itertools.compress(term_ids, missing)
+            self._fingerprints[ids[missing]] = np.fromiter((term_fingerprint(term) for term in terms),
+                                                           dtype=np.uint64, count=int(missing.sum()))
+            self._fingerprinted[ids[missing]] = True
+        return self._fingerprints
+    
+    def vectorize_documents(self, documents: Dict[str, str]) -> Tuple[Dict[str, bytes], Dict[str, Optional[int]]]:
+        """Chunk documents and compute encoded per-chunk term-frequency vectors, extending the vocabulary.
+        
+        Also returns each document's SimHash signature over its terms.
+        """
+        tasks = [(path, content, self.chunk_lines, self.chunk_overlap, self.retriever)
+                 for path, content in documents.items()]
+        
+        # Tokenizing is CPU-bound and holds the GIL, so it only scales across processes;
+        # small batches aren't worth the worker start-up
+        if self.processes > 1 and len(tasks) >= 4 * self.processes:
+            from concurrent.futures import ProcessPoolExecutor
+            
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                results = list(pool.map(tokenize_document, tasks, chunksize=16))
+        else:
+            results = [tokenize_document(task) for task in tasks]
+        
+        chunked = dict(zip(documents, results))
+        
+        vocabulary = self.get_term_ids(set().union(*(counts for _, counts_list in chunked.values() for counts in counts_list)))
+        
+        fingerprints = self.term_fingerprints(vocabulary)
+        
+        vectors = {}
+        signatures = {}
+        for path, (spans, counts_list) in chunked.items():
+            chunk_vectors = []
+            for counts in counts_list:
+                term_ids = np.fromiter((vocabulary[term] for term in counts), dtype=np.uint32, count=len(counts))
+                values = np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))
+                order = np.argsort(term_ids)
+                chunk_vectors.append((term_ids[order], values[order]))
+            vectors[path] = self.encode_chunks(spans, chunk_vectors)
+            
+            # The file's term counts, summed over its chunks
+            term_ids = np.concatenate([ids for ids, _ in chunk_vectors] or [np.zeros(0, dtype=np.uint32)])
+            values = np.concatenate([values for _, values in chunk_vectors] or [np.zeros(0, dtype=np.uint32)])
+            file_terms, inverse = np.unique(term_ids, return_inverse=True)
+            file_counts = np.bincount(inverse, weights=values, minlength=len(file_terms))
+            signatures[path] = simhash(fingerprints[file_terms], file_counts)
+        
+        return vectors, signatures
+    
+    def build_indexed_corpus(self, includes: List[str] = None, excludes: List[str] = None,
+                             changed: List[str] = None, previous: Tuple[StoredCorpus, Dict[str, Tuple[str, bytes]]] = None
+                             ) -> Tuple[StoredCorpus, Dict[str, Tuple[str, bytes]]]:
+        """Build text corpus plus (content hash, term vector) per file, vectorizing only changed files.
+        
+        The corpus is a view over the corpus store: unchanged files are never read, and the
+        text of changed ones is only held until its batch has been stored and vectorized.
+        Rows for files the scan should have found but didn't are dropped along the way.
+        
+        Given previous, the result of an earlier call with the same patterns, and changed, the
+        paths (relative to the root) that may have changed since, only those files are scanned
+        and the rest is carried over from previous.
+        """
+        self.refresh_corpus_store()
+        store = self.corpus_store
+        if previous is not None and previous[0].store is not store:
+            # Its locations point into a store that has been compacted since
+            previous = None
+        
+        with timings.span("scan"):
+            files = self.scan_project_files(includes, excludes, None if previous is None else list(changed))
+        if previous is None:
+            locations, vectors, metadata = {}, {}, {}
+        else:
+            locations, vectors, metadata = dict(previous[0].locations), dict(previous[1]), dict(previous[0].metadata)
+        metadata.update((str(file_info['path']), (file_info['modified'], file_info['size'])) for file_info in files)
+        pending = []
+        now = time.time()
+        
+        if previous is None:
+            print(f"Scanning {len(files)} files...", file=sys.stderr)
+        
+        with timings.span("index cache lookup"):
+            cached_rows = self.get_cached_rows([str(file_info['path']) for file_info in files],
+                                               'content_hash, blob_offset, blob_length, tfidf_vector, simhash')
+        store_size = store.size()
+        
+        for file_info in files:
+            file_path = str(file_info['path'])
+            
+            # Check cache first; a location past the end of the store (lost in a crash) is a miss
+            cached = cached_rows.get(file_path)
+            if cached and (cached[0] != file_info['hash'] or (cached[1] or 0) + cached[2] > store_size):
+                cached = None
+            
+            if cached and cached[3] is not None and file_info['unchanged']:
+                # Placeholders (unreadable or oversized files) have no location and stay out of the corpus
+                if cached[1] is not None:
+                    locations[file_path] = (cached[1], cached[2])
+                    vectors[file_path] = (file_info['hash'], cached[3])
+            else:
+                # New, edited or merely touched: the row is rewritten with fresh stat metadata,
+                # reusing the stored text and vector when the hash shows the bytes are the same
+                pending.append((file_info, cached))
+        
+        with timings.span("find deleted"):
+            if previous is None:
+                deleted = self.find_deleted_rows(includes, excludes, {str(file_info['path']) for file_info in files},
+                                                 len(cached_rows))
+            else:
+                found = {str(file_info['path']) for file_info in files}
+                gone = [path for path in (os.path.join(self.root_path, rel_path) for rel_path in changed)
+                        if path not in found]
+                for path in gone:
+                    locations.pop(path, None)
+                    vectors.pop(path, None)
+                    metadata.pop(path, None)
+                deleted = [path for path in self.get_cached_rows(gone, 'content_hash')
+                           if self.should_include_file(Path(path), includes or self.default_includes,
+                                                       excludes or self.default_excludes)]
+        if not (pending or deleted):
+            return StoredCorpus(store, locations, metadata), vectors
+        
+        if pending:
+            print(f"Indexing {len(pending)} changed files...", file=sys.stderr)
+        
+        timings.count("files indexed", len(pending))
+        skipped = 0
+        
+        # One transaction for the whole scan: vocabulary growth and cache rows commit together
+        with self.vocabulary_transaction(), timings.span("store and vectorize"), self.conn:
+            # Taken before appending, so compaction can't swap the store between the appends
+            # and the commit of the rows that point at them
+            self.conn.execute('BEGIN IMMEDIATE')
+            moved = self.refresh_corpus_store()
+            
+            for batch_start in range(0, len(pending) if not moved else 0, self.INDEX_BATCH_SIZE):
+                batch = []
+                documents = {}
+                
+                for file_info, cached in pending[batch_start:batch_start + self.INDEX_BATCH_SIZE]:
+                    file_path = str(file_info['path'])
+                    if cached:
+                        location = (cached[1], cached[2]) if cached[1] is not None else None
+                        vector, signature = cached[3], cached[4]
+                        if location and vector is None:
+                            content = store.text(*location)
+                            # Indexed before generated files were skipped: demote to a placeholder
+                            if looks_generated(file_info['path'].name, content):
+                                location = None
+                                skipped += 1
+                            else:
+                                documents[file_path] = content
+                    else:
+                        location = vector = signature = None
+                        content = file_info.pop('content', None) or self.extract_file_content(file_info['path'])
+                        if not content or content.startswith("["):  # Skip error messages
+                            pass
+                        elif looks_generated(file_info['path'].name, content):
+                            # Kept as a placeholder row, so the check isn't repeated until the file changes
+                            skipped += 1
+                        else:
+                            data = content.encode('utf-8')
+                            location = (store.append(data), len(data))
+                            documents[file_path] = content
+                    batch.append((file_info, location, vector, signature))
+                
+                # Texts must be on disk before the rows that point at them commit
+                store.sync()
+                with timings.span("vectorize"):
+                    new_vectors, new_signatures = self.vectorize_documents(documents)
+                documents.clear()
+                
+                rows = []
+                for file_info, location, vector, signature in batch:
+                    file_path = str(file_info['path'])
+                    # Placeholders get an empty vector so they are not re-vectorized on every run
+                    if vector is None:
+                        vector = new_vectors.get(file_path, b"")
+                        signature = new_signatures.get(file_path)
+                    offset, length = location or (None, 0)
+                    rows.append((file_path, file_info['hash'], offset, length, vector, file_info['modified'],
+                                 file_info['size'], file_info['mtime_ns'], file_info['inode'], now, signature))
+                    if location:
+                        locations[file_path] = location
+                        vectors[file_path] = (file_info['hash'], vector)
+                    else:
+                        locations.pop(file_path, None)
+                        vectors.pop(file_path, None)
+                
+                self.cache_contents(rows)
+            
+            if not moved:
+                self.conn.executemany('DELETE FROM file_cache WHERE file_path = ?', ((path,) for path in deleted))
+        
+        if moved:
+            # Every location read above belongs to the old store; start over against the new one
+            return self.build_indexed_corpus(includes, excludes)
+        
+        if skipped:
+            print(f"Skipped {skipped} generated or minified files", file=sys.stderr)
+            timings.count("generated files skipped", skipped)
+        if deleted:
+            print(f"Dropped {len(deleted)} deleted files from the cache", file=sys.stderr)
+        if pending:
+            with timings.span("maintain cache"):
+                self.maintain_cache()
+        
+        return StoredCorpus(store, locations, metadata), vectors
+    
+    def find_deleted_rows(self, includes: List[str], excludes: List[str], seen: set, seen_cached: int) -> List[str]:
+        """Cached paths this scan would have listed but didn't find: deleted, renamed or now ignored.
+        
+        Rows outside the scan's patterns are left alone; another query may still want them.
+        """
+        if self.conn.execute('SELECT COUNT(*) FROM file_cache').fetchone()[0] <= seen_cached:
+            return []
+        
+        includes = includes or self.default_includes
+        excludes = excludes or self.default_excludes
+        deleted = []
+        for (file_path,) in self.conn.execute('SELECT file_path FROM file_cache'):
+            if file_path in seen:
+                continue
+            try:
+                if self.should_include_file(Path(file_path), includes, excludes):
+                    deleted.append(file_path)
+            except ValueError:
+                # Not under the root (the partition predates a symlinked root being resolved)
+                deleted.append(file_path)
+        return deleted
+    
+    def maintain_cache(self):
+        """Compact the corpus store when superseded texts dominate it, then apply the cache caps"""
+        live_bytes = self.conn.execute('SELECT COALESCE(SUM(blob_length), 0) FROM file_cache').fetchone()[0]
+        if self.corpus_store.size() > 2 * live_bytes + self.COMPACT_SLACK_BYTES:
+            compact_corpus_store(self.conn, self.cache_dir)
+        
+        if self.max_cache_bytes is not None or self.max_cache_entries is not None:
+            for action in prune_cache(self.cache_root, self.max_cache_bytes, self.max_cache_entries, current=self,
+                                      keep=self.pinned_partitions):
+                print(action, file=sys.stderr)
+    
+    def build_corpus(self, includes: List[str] = None, excludes: List[str] = None) -> Mapping[str, str]:
+        """Build text corpus from project files"""
+        return self.build_indexed_corpus(includes, excludes)[0]
+    
+    def update_index(self, vectors: Dict[str, Tuple[str, bytes]]) -> Tuple[int, np.ndarray]:
+        """Bring the persisted document frequencies for this root in line with the corpus.
+        
+        Every chunk counts as a document. Only files that were added, removed or changed
+        since the last query touch the counts, so the cost is proportional to the size of
+        the change, not of the project.
+        """
+        root = str(self.root_path)
+        row = self.conn.execute('SELECT doc_count, df FROM tfidf_index WHERE root_path = ?', (root,)).fetchone()
+        df = np.frombuffer(row[1], dtype='<u4').astype(np.int64) if row else np.zeros(1, dtype=np.int64)
+        
+        # Hashes first; the per-file counts are only read for the files that changed
+        indexed = dict(self.conn.execute('SELECT file_path, content_hash FROM tfidf_docs WHERE root_path = ?', (root,)))
+        stale = [path for path, content_hash in indexed.items()
+                 if path not in vectors or vectors[path][0] != content_hash]
+        fresh = [path for path, (content_hash, _) in vectors.items()
+                 if path not in indexed or indexed[path] != content_hash]
+        
+        if row and not stale and not fresh:
+            return row[0], df
+        
+        stale_counts = {}
+        for start in range(0, len(stale), SQLITE_BATCH_SIZE):
+            batch = stale[start:start + SQLITE_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            stale_counts.update((path, (chunk_count, term_counts)) for path, chunk_count, term_counts in self.conn.execute(
+                f'SELECT file_path, chunk_count, term_counts FROM tfidf_docs WHERE root_path = ? AND file_path IN ({placeholders})',
+                [root] + batch
+            ))
+        
+        # Per file: how many of its chunks contain each term
+        fresh_counts = {}
+        for path in fresh:
+            spans, _, term_ids, _ = self.decode_chunks(vectors[path][1])
+            unique_ids, chunk_counts = np.unique(term_ids, return_counts=True)
+            fresh_counts[path] = (len(spans), unique_ids, chunk_counts)
+        
+        max_id = max((int(ids[-1]) for _, ids, _ in fresh_counts.values() if len(ids)), default=0)
+        if max_id >= len(df):
+            df = np.concatenate([df, np.zeros(max_id + 1 - len(df), dtype=np.int64)])
+        
+        doc_count = row[0] if row else 0
+        for chunk_count, term_counts in stale_counts.values():
+            term_ids, chunk_counts = self.decode_vector(term_counts)
+            df[term_ids] -= chunk_counts
+            doc_count -= chunk_count
+        for n_chunks, term_ids, chunk_counts in fresh_counts.values():
+            df[term_ids] += chunk_counts
+            doc_count += n_chunks
+        
+        self.conn.executemany('DELETE FROM tfidf_docs WHERE root_path = ? AND file_path = ?',
+                              ((root, path) for path in stale))
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO tfidf_docs (root_path, file_path, content_hash, chunk_count, term_counts) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((root, path, vectors[path][0], n_chunks, self.encode_vector(term_ids, chunk_counts))
+             for path, (n_chunks, term_ids, chunk_counts) in fresh_counts.items())
+        )
+        self.conn.execute('INSERT OR REPLACE INTO tfidf_index (root_path, doc_count, df) VALUES (?, ?, ?)',
+                          (root, doc_count, df.astype('<u4').tobytes()))
+        
+        return doc_count, df
+    
+    def idf_weights(self, doc_count: int, df: np.ndarray) -> np.ndarray:
+        """Smoothed IDF weights, zeroed for terms outside the min_df/max_df window"""
+        idf = np.log((1 + doc_count) / (1 + df)) + 1
+        idf[(df < self.min_df) | (df > self.max_df * doc_count)] = 0
+        return idf
+    
+    def build_chunk_matrix(self, blobs: List[bytes], n_terms: int) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        """Stack the chunk vectors of many files into one CSR matrix, one row per chunk.
+        
+        Returns (file index per chunk, chunk spans, matrix).
+        """
+        from scipy.sparse import csr_matrix
+        
+        decoded = [self.decode_chunks(blob) for blob in blobs]
+        file_index = np.repeat(np.arange(len(decoded)), [len(spans) for spans, _, _, _ in decoded])
+        spans = np.concatenate([spans for spans, _, _, _ in decoded] or [np.zeros((0, 4), dtype=np.uint32)])
+        nnz = np.concatenate([nnz for _, nnz, _, _ in decoded] or [np.zeros(0, dtype=np.uint32)])
+        
+        indptr = np.zeros(len(nnz) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(nnz)
+        indices = np.concatenate([term_ids for _, _, term_ids, _ in decoded] or [np.zeros(0, dtype=np.uint32)])
+        data = np.concatenate([counts for _, _, _, counts in decoded] or [np.zeros(0, dtype=np.uint32)])
+        matrix = csr_matrix((data.astype(np.float64), indices, indptr), shape=(len(nnz), n_terms))
+        
+        return file_index, spans, matrix
+    
+    def bm25_matrix(self, file_paths: List[str], vectors: Dict[str, Tuple[str, bytes]],
+                    n_terms: int) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        """Chunk matrix of BM25 term weights, persisted as memory-mapped .npy files.
+        
+        Term-frequency saturation and length normalisation depend only on the corpus, so
+        they are baked into the stored values and a query is one sparse product. The arrays
+        are rebuilt from the cached chunk vectors whenever any file changes.
+        """
+        import shutil
+        from scipy.sparse import csr_matrix
+        
+        fingerprint = hashlib.sha1(json.dumps(
+            [self.index_generation, self.bm25_k1, self.bm25_b, n_terms, [(path, vectors[path][0]) for path in file_paths]]
+        ).encode()).hexdigest()[:16]
+        root_dir = self.cache_dir / "bm25"
+        index_dir = root_dir / fingerprint
+        names = ("file_index", "spans", "data", "indices", "indptr")
+        
+        try:
+            arrays = {name: np.load(index_dir / f"{name}.npy", mmap_mode='r') for name in names}
+            matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                shape=(len(arrays["indptr"]) - 1, n_terms))
+            return arrays["file_index"], arrays["spans"], matrix
+        except (OSError, ValueError):
+            pass
+        
+        file_index, spans, counts = self.build_chunk_matrix([vectors[path][1] for path in file_paths], n_terms)
+        lengths = np.asarray(counts.sum(axis=1)).ravel()
+        average_length = lengths.mean() if len(lengths) and lengths.mean() else 1.0
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        tf = counts.data
+        data = (tf * (self.bm25_k1 + 1) / (
+            tf + self.bm25_k1 * (1 - self.bm25_b + self.bm25_b * lengths[rows] / average_length)
+        )).astype(np.float32)
+        indices = counts.indices.astype(np.int32)
+        indptr = counts.indptr.astype(np.int64)
+        
+        # Written to a private directory and renamed into place, so readers never see a partial index
+        staging = root_dir / f".{fingerprint}.{os.getpid()}"
+        try:
+            staging.mkdir(parents=True, exist_ok=True)
+            for name, array in zip(names, (file_index, spans, data, indices, indptr)):
+                np.save(staging / f"{name}.npy", np.ascontiguousarray(array))
+            os.replace(staging, index_dir)
+            for stale in root_dir.iterdir():
+                if stale.name != fingerprint and not stale.name.startswith("."):
+                    for stale_file in stale.iterdir():
+                        stale_file.unlink()
+                    stale.rmdir()
+        except OSError:
+            # Another process published an index first; this one is still valid in memory
+            pass
+        finally:
+            # Only still there if it wasn't renamed into place
+            shutil.rmtree(staging, ignore_errors=True)
+        
+        return file_index, spans, csr_matrix((data, indices, indptr), shape=counts.shape)
+    
+    def bm25_scores(self, query_ids: Dict[str, int], query_counts: Counter, doc_count: int, df: np.ndarray,
+                    file_paths: List[str], vectors: Dict[str, Tuple[str, bytes]]) -> Optional[tuple]:
+        """Score every chunk with BM25.
+        
+        Returns (file index per chunk, chunk spans, raw scores), or None when no chunk scores.
+        """
+        query_ids = {term: term_id for term, term_id in query_ids.items() if df[term_id] > 0}
+        if not query_ids:
+            return None
+        
+        file_index, spans, matrix = self.bm25_matrix(file_paths, vectors, len(df))
         
-        # Check includes
-        for pattern in includes:
-            if relative_path.match(pattern):
-                return True
+        query_vector = np.zeros(matrix.shape[1], dtype=np.float32)
+        for term, term_id in query_ids.items():
+            term_df = df[term_id]
+            query_vector[term_id] = query_counts[term] * np.log(1 + (doc_count - term_df + 0.5) / (term_df + 0.5))
         
-        return False
+        scores = matrix @ query_vector
+        if not len(scores) or scores.max() <= 0:
+            return None
+        return file_index, spans, scores
     
-    def extract_file_content(self, file_path: Path, max_size: int = 100000) -> str:
-        """Extract readable content from file"""
-        try:
-            if file_path.stat().st_size > max_size:
-                return f"[File too large: {file_path.name}]"
-            
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-                
-            # Add file header for context
-            relative_path = file_path.relative_to(self.root_path)
-            return f"File: {relative_path}\n{'='*50}\n{content}\n\n"
-            
-        except Exception as e:
-            return f"[Error reading {file_path.name}: {str(e)}]"
+    def tfidf_scores(self, query_ids: Dict[str, int], query_counts: Counter, doc_count: int, df: np.ndarray,
+                     file_paths: List[str], vectors: Dict[str, Tuple[str, bytes]]) -> Optional[tuple]:
+        """Score every chunk by TF-IDF cosine similarity to the query.
+        
+        Returns (file index per chunk, chunk spans, similarities), or None for an empty query vector.
+        """
+        # The query counts as one more document, as it did when it was fitted with the corpus
+        df = df.copy()
+        df[list(query_ids.values())] += 1
+        weights = self.idf_weights(doc_count + 1, df)
+        
+        # Only the prompt is vectorized here; chunks come from the persisted index
+        query_vector = np.zeros(len(weights))
+        for term, term_id in query_ids.items():
+            query_vector[term_id] = query_counts[term] * weights[term_id]
+        
+        query_norm = np.linalg.norm(query_vector)
+        if not query_norm:
+            return None
+        
+        file_index, spans, matrix = self.build_chunk_matrix([vectors[path][1] for path in file_paths], len(weights))
+        doc_norms = np.sqrt(matrix.power(2) @ np.square(weights))
+        doc_norms[doc_norms == 0] = 1
+        
+        # Folding the IDF weights into the query keeps this to one product with raw counts
+        return file_index, spans, (matrix @ (query_vector * weights / query_norm)) / doc_norms
     
-    def scan_project_files(self, includes: List[str] = None, excludes: List[str] = None) -> List[Dict[str, Any]]:
-        """Scan project files and return list with metadata"""
-        includes = includes or self.default_includes
-        excludes = excludes or self.default_excludes
+    def file_priors(self, corpus: StoredCorpus, file_paths: List[str], weights: Dict[str, float] = None,
+                    cwd: str = None, newest: float = None) -> np.ndarray:
+        """Per-file score multipliers from the scan's metadata: recency, locality to cwd and size.
         
-        files = []
+        weights override RERANK_WEIGHTS; cwd defaults to the current directory, and gives no
+        locality signal when it is the project root or outside it. Recency is measured from
+        newest, by default the corpus's newest file.
+        """
+        unknown = set(weights or ()) - set(self.RERANK_WEIGHTS)
+        if unknown:
+            raise ValueError(f"Unknown re-ranking weights: {', '.join(sorted(unknown))} "
+                             f"(expected: {', '.join(self.RERANK_WEIGHTS)})")
+        weights = dict(self.RERANK_WEIGHTS, **(weights or {}))
         
-        for file_path in self.root_path.rglob("*"):
-            if file_path.is_file() and self.should_include_file(file_path, includes, excludes):
-                try:
-                    stat = file_path.stat()
-                    content_hash = self.get_file_hash(file_path)
-                    
-                    files.append({
-                        'path': file_path,
-                        'relative_path': file_path.relative_to(self.root_path),
-                        'size': stat.st_size,
-                        'modified': stat.st_mtime,
-                        'hash': content_hash
-                    })
-                except Exception:
-                    continue
+        metadata = [corpus.metadata.get(path, (0.0, 0)) for path in file_paths]
+        mtimes, sizes = np.array(metadata, dtype=np.float64).reshape(-1, 2).T
+        priors = np.ones(len(file_paths))
+        if weights["recency"]:
+            newest = corpus.newest if newest is None else newest
+            priors += weights["recency"] * 0.5 ** (np.maximum(newest - mtimes, 0) / self.RECENCY_HALF_LIFE)
+        if weights["size"]:
+            priors += weights["size"] / (1 + sizes / self.SIZE_REFERENCE)
         
-        return files
+        root = str(self.root_path)
+        cwd = os.path.abspath(cwd or os.getcwd())
+        if weights["locality"] and cwd.startswith(root + os.sep):
+            # Fraction of the working directory's path (below the root) the file's directory shares
+            cwd_parts = cwd[len(root) + 1:].split(os.sep)
+            for i, path in enumerate(file_paths):
+                shared = 0
+                for file_part, cwd_part in zip(path[len(root) + 1:].split(os.sep)[:-1], cwd_parts):
+                    if file_part != cwd_part:
+                        break
+                    shared += 1
+                priors[i] += weights["locality"] * shared / len(cwd_parts)
+        return priors
     
-    def get_cached_content(self, file_path: Path, content_hash: str, modified_time: float) -> Optional[Tuple[str, Optional[str]]]:
-        """Get cached content and TF-IDF vector if available and up-to-date"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute(
-                'SELECT content, tfidf_vector, content_hash, last_modified FROM file_cache WHERE file_path = ?',
-                (str(file_path),)
-            )
-            row = cursor.fetchone()
-            
-            if row and row[2] == content_hash and row[3] == modified_time:
-                return row[0], row[1]
+    def file_signature(self, file_path: str) -> Tuple[Optional[str], Optional[int]]:
+        """(content hash, SimHash signature) stored for file_path, either None if it has none"""
+        row = self.conn.execute('SELECT content_hash, simhash FROM file_cache WHERE file_path = ?',
+                                (file_path,)).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+    
+    def is_near_duplicate(self, signature: Tuple[Optional[str], Optional[int]], others) -> bool:
+        """Whether signature (see file_signature) is a copy of any of others.
         
-        return None
+        Identical content hashes make an exact copy, however small the file; otherwise the
+        SimHash signatures must be within NEAR_DUPLICATE_BITS.
+        """
+        content_hash, simhash = signature
+        return any(
+            (content_hash is not None and content_hash == other_hash) or
+            (simhash is not None and other_simhash is not None and
+             hamming_distance(simhash, other_simhash) <= self.NEAR_DUPLICATE_BITS)
+            for other_hash, other_simhash in others
+        )
     
-    def cache_content(self, file_path: Path, content: str, content_hash: str, modified_time: float, tfidf_vector: str = None):
-        """Cache file content and TF-IDF vector"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                INSERT OR REPLACE INTO file_cache 
-                (file_path, content_hash, content, tfidf_vector, last_modified)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (str(file_path), content_hash, content, tfidf_vector, modified_time))
+    def format_chunk(self, file_path: str, text: str, first_line: int) -> str:
+        """Render a chunk's text with its file and line range"""
+        # Trailing newlines aren't counted: the last chunk ends in read_file's padding
+        last_line = first_line + text.rstrip("\n").count("\n")
+        relative_path = Path(file_path).relative_to(self.label_root)
+        return f"File: {relative_path} (lines {first_line}-{last_line})\n{'='*50}\n{text}\n"
     
-    def build_corpus(self, includes: List[str] = None, excludes: List[str] = None) -> Dict[str, str]:
-        """Build text corpus from project files"""
-        files = self.scan_project_files(includes, excludes)
-        corpus = {}
+    def select_relevant_snippets(self, query: str, **kwargs) -> str:
+        """The selected chunks joined into one context block; see select_relevant_chunks"""
+        return join_snippets(self.select_relevant_chunks(query, **kwargs))
+    
+    def select_relevant_chunks(self, query: str, k: int = 5, includes: List[str] = None, 
+                               excludes: List[str] = None, budget_chars: int = 8000,
+                               budget_tokens: int = None, token_ratio: float = 1.0,
+                               rerank_weights: Dict[str, float] = None, cwd: str = None) -> List[str]:
+        """Select most relevant code chunks using TF-IDF similarity (BM25 with the builtin retriever).
         
-        print(f"Scanning {len(files)} files...")
+        Chunks are ranked individually, re-ranked by file metadata (see file_priors, with
+        rerank_weights over RERANK_WEIGHTS and locality relative to cwd), and packed greedily,
+        best first, into budget_chars, drawing from at most k distinct files. Given
+        budget_tokens, the budget is counted in tokens instead, using each chunk's estimate
+        from indexing scaled by token_ratio. Returns the formatted chunks, best first.
+        """
+        prepared = self.prepare_query(query, includes, excludes)
+        if prepared is None:
+            return []
+        corpus, _, file_paths = prepared[:3]
         
-        for file_info in files:
-            file_path = file_info['path']
-            content_hash = file_info['hash']
-            modified_time = file_info['modified']
-            
-            # Check cache first
-            cached = self.get_cached_content(file_path, content_hash, modified_time)
-            if cached:
-                content = cached[0]
-            else:
-                content = self.extract_file_content(file_path)
-                self.cache_content(file_path, content, content_hash, modified_time)
-            
-            if content and not content.startswith("["):  # Skip error messages
-                corpus[str(file_path)] = content
+        scored = self.score_query(prepared)
+        if scored is None:
+            return self.fallback_selection(corpus, k, budget_chars, budget_tokens, token_ratio, rerank_weights, cwd)
+        file_index, spans, similarities = scored
+        timings.count("chunks scored", len(similarities))
+        if self.retriever == "builtin":
+            # Normalised to the best chunk, so BM25 shares the TF-IDF similarity threshold
+            similarities = similarities / similarities.max()
+        
+        ranking = self.rerank_chunks(corpus, file_paths, file_index, similarities, rerank_weights, cwd)
+        order = np.argsort(-ranking, kind='stable')[:np.count_nonzero(ranking)]
+        result_parts = pack_chunks(
+            ((self, corpus, file_paths[file_index[idx]], spans[idx], similarities[idx]) for idx in order),
+            k, budget_chars, budget_tokens, token_ratio
+        )
         
-        return corpus
+        if not result_parts:
+            return self.fallback_selection(corpus, k, budget_chars, budget_tokens, token_ratio, rerank_weights, cwd)
+        
+        return result_parts
     
-    def select_relevant_snippets(self, query: str, k: int = 5, includes: List[str] = None, 
-                               excludes: List[str] = None, budget_chars: int = 8000) -> str:
-        """Select most relevant code snippets using TF-IDF similarity"""
+    def prepare_query(self, query: str, includes: List[str] = None, excludes: List[str] = None) -> Optional[tuple]:
+        """Scan and index the project and look up the query's terms, ready for score_query.
         
+        Returns (corpus, vectors, file paths, query term counts, query term ids, document
+        count, document frequencies), or None when no file matches.
+        """
         # Build corpus
-        corpus = self.build_corpus(includes, excludes)
+        self.record_access()
+        with timings.span("build corpus"):
+            corpus, vectors = self.build_indexed_corpus(includes, excludes)
         
         if not corpus:
-            return "No files found in project."
+            return None
         
-        # Prepare documents for TF-IDF
         file_paths = list(corpus.keys())
-        documents = [corpus[path] for path in file_paths]
-        documents.append(query)  # Add query as last document
-        
-        # Compute TF-IDF vectors
-        print("Computing TF-IDF vectors...")
-        vectorizer = TfidfVectorizer(
-            stop_words='english',
-            max_features=5000,
-            ngram_range=(1, 2),
-            max_df=0.8,
-            min_df=2
-        )
+        query_counts = Counter(self.analyzer(query))
+        
+        with timings.span("update index"), self.conn:
+            # Take the write lock before reading so concurrent runs apply their deltas one at a time
+            self.conn.execute('BEGIN IMMEDIATE')
+            doc_count, df = self.update_index(vectors)
+        query_ids = self.get_term_ids(query_counts, create=False)
+        query_ids = {term: term_id for term, term_id in query_ids.items() if term_id < len(df)}
+        
+        return corpus, vectors, file_paths, query_counts, query_ids, doc_count, df
+    
+    def score_query(self, prepared: tuple, doc_count: int = None, term_df: Dict[str, int] = None) -> Optional[tuple]:
+        """Score every chunk against a prepare_query result (BM25 with the builtin retriever).
+        
+        doc_count and term_df (document frequency per query term) stand in for this root's
+        own statistics, so a workspace scores all of its roots on one scale. Returns (file
+        index per chunk, chunk spans, scores), or None when nothing scores.
+        """
+        corpus, vectors, file_paths, query_counts, query_ids, own_doc_count, df = prepared
+        if term_df is not None:
+            df = df.copy()
+            for term, term_id in query_ids.items():
+                df[term_id] = term_df[term]
+        
+        score_chunks = self.bm25_scores if self.retriever == "builtin" else self.tfidf_scores
+        with timings.span("score chunks"):
+            return score_chunks(query_ids, query_counts, own_doc_count if doc_count is None else doc_count, df,
+                                file_paths, vectors)
+    
+    def rerank_chunks(self, corpus: StoredCorpus, file_paths: List[str], file_index: np.ndarray,
+                      similarities: np.ndarray, rerank_weights: Dict[str, float] = None, cwd: str = None,
+                      newest: float = None) -> np.ndarray:
+        """Ranking score per chunk: its similarity, if over the threshold, times its file's prior.
+        
+        Metadata reorders matching chunks but can't lift a chunk that doesn't match the query;
+        see file_priors for the remaining arguments.
+        """
+        with timings.span("rerank"):
+            ranking = np.where(similarities > 0.01, similarities, 0.0)
+            candidates = np.unique(file_index[ranking > 0])
+            priors = np.ones(len(file_paths))
+            priors[candidates] = self.file_priors(corpus, [file_paths[i] for i in candidates], rerank_weights,
+                                                  cwd, newest)
+            ranking *= priors[file_index]
+        return ranking
+    
+    def fallback_ranking(self, corpus: StoredCorpus, rerank_weights: Dict[str, float] = None, cwd: str = None,
+                         newest: float = None) -> List[Tuple[float, float, str]]:
+        """(prior, mtime, path) for every file, in the order fallback_selection takes them"""
+        files = list(corpus)
+        
+        # Scan metadata only: no stat calls
+        priors = self.file_priors(corpus, files, rerank_weights, cwd, newest)
+        return sorted(zip(priors, (corpus.metadata.get(path, (0.0, 0))[0] for path in files), files), reverse=True)
+    
+    def fallback_selection(self, corpus: StoredCorpus, k: int, budget_chars: int,
+                           budget_tokens: int = None, token_ratio: float = 1.0,
+                           rerank_weights: Dict[str, float] = None, cwd: str = None) -> List[str]:
+        """Fallback selection when TF-IDF fails - use the files file_priors ranks highest, newest first on ties"""
+        ranked = self.fallback_ranking(corpus, rerank_weights, cwd)
+        return pack_files(((self, corpus, path) for _, _, path in ranked), k, budget_chars, budget_tokens, token_ratio)
+
+class WarmProjectMemory(ProjectMemory):
+    """ProjectMemory that keeps its scan and index in memory until files change.
+    
+    Used by the daemon: between changes a query skips the walk, the cache reads and
+    the matrix assembly, leaving only query scoring and packing. After a change only the
+    changed files are stat'ed and re-vectorized; the matrices are then reassembled from
+    the vectors already in memory.
+    """
+    
+    # More changed files than this (a branch switch, say) are cheaper to find with a full scan
+    MAX_INCREMENTAL_FILES = 1000
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stale = True
+        self.changed = set()
+        self._changes_lock = threading.Lock()
+        self._corpora = {}
+        self._indexes = {}
+        self._matrices = {}
+        self._decoded = {}
+    
+    def invalidate(self, paths: Iterable[str] = None):
+        """Record changed files (relative to the root) for the next query, or with None that any may have changed"""
+        if paths is not None and (self.respect_gitignore or self.scanner == "git"):
+            paths = set(paths)
+            # An edited .gitignore can include or exclude files that didn't change themselves
+            if any(path.rpartition("/")[2] == ".gitignore" for path in paths):
+                paths = None
+        
+        with self._changes_lock:
+            if paths is None:
+                self.stale = True
+            else:
+                self.changed.update(paths)
+    
+    def build_indexed_corpus(self, includes: List[str] = None,
+                             excludes: List[str] = None) -> Tuple[StoredCorpus, Dict[str, Tuple[str, bytes]]]:
+        # Taken before updating, so a change made during the update triggers another one
+        with self._changes_lock:
+            stale, changed = self.stale, self.changed
+            self.stale, self.changed = False, set()
+        
+        if stale or len(changed) > self.MAX_INCREMENTAL_FILES:
+            self._corpora.clear()
+            self._indexes.clear()
+            self._matrices.clear()
+            self._decoded.clear()
+        elif changed:
+            replaced = False
+            for key, (corpus, vectors) in list(self._corpora.items()):
+                corpus, new_vectors = super().build_indexed_corpus(list(key[0]) or None, list(key[1]) or None,
+                                                                   sorted(changed), (corpus, vectors))
+                if new_vectors == vectors:
+                    # Only stat metadata moved; the memoized index and matrices still hold
+                    new_vectors = vectors
+                else:
+                    replaced = True
+                self._corpora[key] = (corpus, new_vectors)
+            if replaced:
+                self._indexes.clear()
+                self._matrices.clear()
+                live = {blob for _, vectors in self._corpora.values() for _, blob in vectors.values()}
+                self._decoded = {blob: decoded for blob, decoded in self._decoded.items() if blob in live}
+        
+        key = (tuple(includes or ()), tuple(excludes or ()))
+        if key not in self._corpora:
+            self._corpora[key] = super().build_indexed_corpus(includes, excludes)
+        return self._corpora[key]
+    
+    # The memoized results are keyed on the identity of the vectors/blobs they were built
+    # from; the cached corpora keep those objects alive, so the ids can't be reused
+    
+    def update_index(self, vectors: Dict[str, Tuple[str, bytes]]) -> Tuple[int, np.ndarray]:
+        if id(vectors) not in self._indexes:
+            self._indexes[id(vectors)] = super().update_index(vectors)
+        return self._indexes[id(vectors)]
+    
+    def decode_chunks(self, blob: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Unchanged files keep their blob objects across updates, so rebuilding a matrix
+        # after a change decodes only the changed files
+        if blob not in self._decoded:
+            self._decoded[blob] = ProjectMemory.decode_chunks(blob)
+        return self._decoded[blob]
+    
+    def build_chunk_matrix(self, blobs: List[bytes], n_terms: int) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        key = ("tfidf", n_terms, tuple(map(id, blobs)))
+        if key not in self._matrices:
+            self._matrices[key] = super().build_chunk_matrix(blobs, n_terms)
+        return self._matrices[key]
+    
+    def bm25_matrix(self, file_paths: List[str], vectors: Dict[str, Tuple[str, bytes]],
+                    n_terms: int) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        key = ("bm25", n_terms, id(vectors))
+        if key not in self._matrices:
+            self._matrices[key] = super().bm25_matrix(file_paths, vectors, n_terms)
+        return self._matrices[key]
+
+class Workspace:
+    """Several project roots indexed and queried as one.
+    
+    Each root is a shard: an ordinary ProjectMemory with its own cache partition, scanned
+    and refreshed independently of the others. A query prepares and scores the shards in
+    parallel, with the query terms' document frequencies summed over every root so their
+    scores are comparable, then merges the chunks by score under a single budget.
+    """
+    
+    def __init__(self, roots: List[str], **kwargs):
+        """Open a ProjectMemory for each of roots; kwargs are passed to every one"""
+        resolved = list(dict.fromkeys(Path(root).resolve() for root in roots))
+        if not resolved:
+            raise ValueError("A workspace needs at least one root")
+        for root in resolved:
+            for other in resolved:
+                if other in root.parents:
+                    raise ValueError(f"Workspace roots overlap: {root} is inside {other}")
         
+        self.roots = resolved
+        self.shards = []
         try:
-            tfidf_matrix = vectorizer.fit_transform(documents)
-        except ValueError:
-            # Fallback if TF-IDF fails
-            return self.fallback_selection(corpus, k, budget_chars)
+            for root in resolved:
+                self.shards.append(ProjectMemory(str(root), **kwargs))
+        except Exception:
+            self.close()
+            raise
         
-        # Compute similarity between query and documents
-        query_vector = tfidf_matrix[-1]  # Last document is the query
-        document_vectors = tfidf_matrix[:-1]  # All except query
+        # Chunk headers are relative to the roots' common parent, so they say which root a file is in
+        label_root = Path(os.path.commonpath([str(root) for root in resolved]))
+        for shard in self.shards:
+            shard.label_root = label_root
+            shard.pinned_partitions = tuple(other.cache_dir for other in self.shards if other is not shard)
+    
+    def close(self):
+        """Close every shard"""
+        for shard in self.shards:
+            shard.close()
+    
+    def select_relevant_snippets(self, query: str, **kwargs) -> str:
+        """The selected chunks joined into one context block; see select_relevant_chunks"""
+        return join_snippets(self.select_relevant_chunks(query, **kwargs))
+    
+    def select_relevant_chunks(self, query: str, k: int = 5, includes: List[str] = None,
+                               excludes: List[str] = None, budget_chars: int = 8000,
+                               budget_tokens: int = None, token_ratio: float = 1.0,
+                               rerank_weights: Dict[str, float] = None, cwd: str = None) -> List[str]:
+        """ProjectMemory.select_relevant_chunks over every root, with k and the budget shared by all"""
+        from concurrent.futures import ThreadPoolExecutor
         
-        similarities = cosine_similarity(query_vector, document_vectors).flatten()
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as pool:
+            with timings.span("prepare shards"):
+                prepared = list(pool.map(timings.bind(lambda shard: shard.prepare_query(query, includes, excludes)),
+                                         self.shards))
+            live = [(shard, shard_query) for shard, shard_query in zip(self.shards, prepared)
+                    if shard_query is not None]
+            if not live:
+                return []
+            
+            # Workspace-wide statistics: a term common in one repo but rare overall weighs as rare
+            doc_count = 0
+            term_df = Counter()
+            for _, (_, _, _, _, query_ids, shard_doc_count, df) in live:
+                doc_count += shard_doc_count
+                for term, term_id in query_ids.items():
+                    term_df[term] += int(df[term_id])
+            
+            with timings.span("score shards"):
+                scored = list(pool.map(timings.bind(lambda item: item[0].score_query(item[1], doc_count, term_df)),
+                                       live))
         
-        # Get top-k most similar documents
-        top_indices = similarities.argsort()[-k:][::-1]
+        # Recency is measured from the newest file in any root
+        newest = max(shard_query[0].newest for _, shard_query in live)
+        hits = [(shard, shard_query, shard_scores)
+                for (shard, shard_query), shard_scores in zip(live, scored) if shard_scores is not None]
         
-        # Build result within budget
         result_parts = []
-        total_chars = 0
-        
-        for idx in top_indices:
-            if total_chars >= budget_chars:
-                break
-                
-            file_path = file_paths[idx]
-            content = corpus[file_path]
-            similarity_score = similarities[idx]
-            
-            if similarity_score > 0.01:  # Minimum similarity threshold
-                # Truncate content if needed
-                remaining_budget = budget_chars - total_chars
-                if len(content) > remaining_budget:
-                    content = content[:remaining_budget] + "... [truncated]"
-                
-                result_parts.append(f"Similarity: {similarity_score:.3f}\n{content}")
-                total_chars += len(content)
+        if hits:
+            timings.count("chunks scored", sum(len(shard_scores[2]) for _, _, shard_scores in hits))
+            
+            # BM25 is normalised to the best chunk in the whole workspace, not per root
+            best = 1.0
+            if self.shards[0].retriever == "builtin":
+                best = max(shard_scores[2].max() for _, _, shard_scores in hits)
+            
+            merged = []
+            for shard, shard_query, (file_index, spans, similarities) in hits:
+                similarities = similarities / best
+                ranking = shard.rerank_chunks(shard_query[0], shard_query[2], file_index, similarities,
+                                              rerank_weights, cwd, newest)
+                merged.append((shard, shard_query, file_index, spans, similarities, ranking))
+            
+            rankings = np.concatenate([ranking for *_, ranking in merged])
+            offsets = np.cumsum([0] + [len(ranking) for *_, ranking in merged])
+            order = np.argsort(-rankings, kind='stable')[:np.count_nonzero(rankings)]
+            
+            def candidates():
+                for idx in order:
+                    hit = np.searchsorted(offsets, idx, side='right') - 1
+                    shard, (corpus, _, file_paths, *_), file_index, spans, similarities, _ = merged[hit]
+                    idx -= offsets[hit]
+                    yield shard, corpus, file_paths[file_index[idx]], spans[idx], similarities[idx]
+            
+            result_parts = pack_chunks(candidates(), k, budget_chars, budget_tokens, token_ratio)
         
         if not result_parts:
-            return self.fallback_selection(corpus, k, budget_chars)
+            ranked = sorted(
+                ((prior, mtime, path, n) for n, (shard, shard_query) in enumerate(live)
+                 for prior, mtime, path in shard.fallback_ranking(shard_query[0], rerank_weights, cwd, newest)),
+                reverse=True
+            )
+            result_parts = pack_files(((live[n][0], live[n][1][0], path) for _, _, path, n in ranked),
+                                      k, budget_chars, budget_tokens, token_ratio)
         
-        return "\n" + "="*80 + "\n".join(result_parts)
+        return result_parts
+
+class ProjectWatcher:
+    """Calls on_change when files under a project root change.
     
-    def fallback_selection(self, corpus: Dict[str, str], k: int, budget_chars: int) -> str:
-        """Fallback selection when TF-IDF fails - use most recently modified files"""
-        files = [(path, content) for path, content in corpus.items()]
-        
-        # Sort by modification time (get from filesystem)
-        def get_mtime(item):
+    Uses inotify on Linux, watching every directory the scan doesn't prune; elsewhere,
+    or when inotify is unavailable or out of watches, it polls stat metadata instead.
+    on_change gets the set of changed paths relative to the root, or None when changes
+    can't be pinned to files (a dropped event queue, a directory moved away) and
+    everything should be rescanned.
+    """
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    
+    def __init__(self, memory: ProjectMemory, matcher: PathMatcher, on_change, poll_interval: float = 2.0,
+                 force_polling: bool = False):
+        self.memory = memory
+        self.matcher = matcher
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.force_polling = force_polling
+        self.method = None
+    
+    def start(self):
+        """Start watching on a background thread; returns the method in use ("inotify" or "polling")"""
+        target = self.run_polling
+        if not self.force_polling and sys.platform.startswith("linux"):
             try:
-                return Path(item[0]).stat().st_mtime
-            except:
-                return 0
+                self.inotify_fd = self.init_inotify()
+                target = self.run_inotify
+            except OSError as e:
+                print(f"inotify unavailable ({e}), polling every {self.poll_interval}s", file=sys.stderr)
         
-        files.sort(key=get_mtime, reverse=True)
+        self.method = "inotify" if target == self.run_inotify else "polling"
+        threading.Thread(target=target, name="project-watcher", daemon=True).start()
+        return self.method
+    
+    def init_inotify(self) -> int:
+        """Create an inotify instance watching every unpruned directory under the root"""
+        import ctypes
+        import ctypes.util
         
-        result_parts = []
-        total_chars = 0
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
         
-        for file_path, content in files[:k]:
-            if total_chars >= budget_chars:
-                break
-            
-            remaining_budget = budget_chars - total_chars
-            if len(content) > remaining_budget:
-                content = content[:remaining_budget] + "... [truncated]"
+        self.watches = {}
+        try:
+            self.add_watches(fd, str(self.memory.root_path), "")
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+    
+    def add_watches(self, fd: int, dir_path: str, rel_dir: str) -> List[str]:
+        """Watch dir_path and its subdirectories, skipping the ones the scan prunes.
+        
+        Returns the relative paths of the matching files found on the way, which a directory
+        created or moved in brought along without events of their own.
+        """
+        import ctypes
+        
+        files = []
+        stack = [(dir_path, rel_dir)]
+        while stack:
+            dir_path, rel_dir = stack.pop()
+            wd = self.libc.inotify_add_watch(fd, os.fsencode(dir_path), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC: out of inotify watches
+                    raise OSError(errno, "inotify watch limit reached (fs.inotify.max_user_watches)")
+                continue
+            self.watches[wd] = rel_dir
             
-            result_parts.append(content)
-            total_chars += len(content)
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        rel_path = rel_dir + entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.matcher.prune_dir(rel_path):
+                                stack.append((entry.path, rel_path + "/"))
+                        elif self.matcher.match_file(rel_path):
+                            files.append(rel_path)
+            except OSError:
+                continue
+        return files
+    
+    def run_inotify(self):
+        """Read inotify events forever, reporting changes to files the scan could see"""
+        import struct
         
-        return "\n" + "="*80 + "\n".join(result_parts)
+        header = struct.Struct("iIII")
+        while True:
+            data = os.read(self.inotify_fd, 65536)
+            changed = set()
+            rescan = False
+            offset = 0
+            
+            while offset < len(data):
+                wd, mask, _, length = header.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + header.size:offset + header.size + length].rstrip(b"\0"))
+                offset += header.size + length
+                
+                if mask & self.IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                rel_dir = self.watches.get(wd)
+                if rel_dir is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                
+                rel_path = rel_dir + name
+                if mask & self.IN_ISDIR:
+                    if self.matcher.prune_dir(rel_path):
+                        continue
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        try:
+                            changed.update(self.add_watches(self.inotify_fd, os.path.join(self.memory.root_path, rel_path),
+                                                            rel_path + "/"))
+                        except OSError as e:
+                            print(f"Cannot watch {rel_path}: {e}", file=sys.stderr)
+                            rescan = True
+                    elif mask & self.IN_MOVED_FROM:
+                        # Its files left without events of their own
+                        rescan = True
+                elif name and self.matcher.match_file(rel_path):
+                    changed.add(rel_path)
+            
+            if rescan:
+                self.on_change(None)
+            elif changed:
+                self.on_change(changed)
+    
+    def snapshot(self) -> Dict[str, Tuple[int, int, int]]:
+        """Stat metadata of every file the scan would see"""
+        files = {}
+        for entry, rel_path in self.memory.walk_project(self.matcher):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files[rel_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return files
+    
+    def run_polling(self):
+        """Compare stat snapshots every poll_interval seconds"""
+        previous = self.snapshot()
+        while True:
+            time.sleep(self.poll_interval)
+            current = self.snapshot()
+            if current != previous:
+                changed = {path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path)}
+                previous = current
+                self.on_change(changed)
 
 class PerspectivesCLI:
     """CLI tool for the Perspectives API"""
@@ -282,10 +2957,22 @@ class PerspectivesCLI:
             "max_messages": 10,
             "temperature": 0.7,
             "max_tokens": 2000,
+            "context_tokens": 2000,
+            "respect_gitignore": False,
+            "retriever": "sklearn",
+            "scanner": "walk",
+            "rerank_weights": dict(ProjectMemory.RERANK_WEIGHTS),
+            "cache_max_bytes": 1024 ** 3,
+            "cache_max_entries": 500000,
+            "response_cache_ttl": 3600,
+            "response_cache_max_bytes": 64 * 1024 ** 2,
             "byo_keys": {}
         }
         
         self.config = self.load_config()
+        self._session = None
+        self._response_cache = None
+        self._server_state = None
     
     def load_config(self) -> Dict[str, Any]:
         """Load configuration from file"""
@@ -305,8 +2992,175 @@ class PerspectivesCLI:
         with open(self.config_file, 'w') as f:
             json.dump(self.config, f, indent=2)
     
-    def call_perspectives_api(self, prompt: str, **kwargs) -> Dict[str, Any]:
-        """Call the perspectives API"""
+    def get_session(self, pool_size: int = 10) -> requests.Session:
+        """Shared HTTP session, so repeated calls reuse pooled keep-alive connections"""
+        if self._session is None:
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+        return self._session
+    
+    def get_response_cache(self) -> ResponseCache:
+        """The local response cache, opened on first use"""
+        if self._response_cache is None:
+            cache_root = self.config_dir / "cache"
+            cache_root.mkdir(exist_ok=True)
+            self._response_cache = ResponseCache(cache_root / "responses.db", self.config["response_cache_ttl"],
+                                                 self.config["response_cache_max_bytes"])
+        return self._response_cache
+    
+    def get_server_state(self) -> ServerState:
+        """What earlier runs learned about the API servers, loaded on first use"""
+        if self._server_state is None:
+            cache_root = self.config_dir / "cache"
+            cache_root.mkdir(exist_ok=True)
+            self._server_state = ServerState(cache_root / "servers.json")
+        return self._server_state
+    
+    def lookup_response(self, request_data: Dict[str, Any], **kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """(cache key, cached response or None) for request_data; (None, None) with no_cache"""
+        if kwargs.get("no_cache"):
+            return None, None
+        
+        with timings.span("response cache lookup"):
+            key = ResponseCache.request_key(self.config["api_url"], request_data)
+            response = self.get_response_cache().get(key, kwargs.get("cache_ttl"))
+        timings.count("response cache hits" if response is not None else "response cache misses")
+        return key, response
+    
+    def fetch_response(self, request_data: Dict[str, Any], retries: int = 0, cache_key: str = None) -> Dict[str, Any]:
+        """post_request, storing the response in the response cache under cache_key if given"""
+        response = self.post_request(request_data, retries=retries)
+        if cache_key:
+            self.get_response_cache().put(cache_key, response)
+        return response
+    
+    def open_project_memory(self, **kwargs) -> ProjectMemory | Workspace:
+        """Create a ProjectMemory for kwargs["project_root"] using the request's scan options.
+        
+        A list of roots gets a Workspace with one ProjectMemory per root.
+        """
+        roots = kwargs["project_root"]
+        memory_class = ProjectMemory if isinstance(roots, str) else Workspace
+        return memory_class(
+            roots,
+            respect_gitignore=kwargs.get("respect_gitignore", self.config["respect_gitignore"]),
+            jobs=kwargs.get("jobs"),
+            processes=kwargs.get("processes", 0),
+            retriever=kwargs.get("retriever", self.config["retriever"]),
+            max_cache_bytes=self.config["cache_max_bytes"],
+            max_cache_entries=self.config["cache_max_entries"],
+            scanner=kwargs.get("scanner", self.config["scanner"])
+        )
+    
+    def plan_context_budget(self, prompt: str, models: List[str], max_tokens: int,
+                            context_tokens: int = None) -> Dict[str, Any]:
+        """Token budget for project context that fits every requested model.
+        
+        The limiting model is the one with the least room once its answer (max_tokens),
+        the prompt and the template are accounted for; the budget is context_tokens (default:
+        the context_tokens setting) in that model's tokens, capped to that room.
+        """
+        prompt_estimate = estimate_tokens(prompt)
+        room = {}
+        for model in models:
+            window, ratio = model_token_limits(model)
+            available = window - max_tokens - PROMPT_OVERHEAD_TOKENS - math.ceil(prompt_estimate * ratio)
+            room[model] = (available / ratio, available, window, ratio)
+        
+        limiting_model = min(room, key=lambda model: room[model][0])
+        _, available, window, ratio = room[limiting_model]
+        requested = context_tokens if context_tokens is not None else self.config["context_tokens"]
+        return {
+            "budget_tokens": max(0, min(requested, available)),
+            "room_tokens": available,
+            "token_ratio": ratio,
+            "limiting_model": limiting_model,
+            "context_window": window
+        }
+    
+    def request_budget(self, prompt: str, **kwargs) -> Optional[Dict[str, Any]]:
+        """plan_context_budget for the request build_request makes from kwargs.
+        
+        None when an explicit character budget (context_budget) applies instead.
+        """
+        if kwargs.get("context_budget") is not None:
+            return None
+        return self.plan_context_budget(prompt, kwargs.get("models", self.config["default_models"]),
+                                        kwargs.get("max_tokens", self.config["max_tokens"]),
+                                        kwargs.get("context_tokens"))
+    
+    def estimate_request_tokens(self, request_data: Dict[str, Any], budget: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Estimated prompt tokens per model for the final request, for --output json"""
+        prompt_estimate = estimate_tokens(inline_context(request_data)["prompt"])
+        models = {}
+        for model in request_data["models"]:
+            window, ratio = model_token_limits(model)
+            models[model] = {
+                "prompt_tokens": math.ceil(prompt_estimate * ratio),
+                "max_tokens": request_data["max_tokens"],
+                "context_window": window
+            }
+        
+        estimate = {"estimator": "heuristic", "models": models}
+        if budget:
+            estimate.update(context_budget_tokens=budget["budget_tokens"], limiting_model=budget["limiting_model"])
+        return estimate
+    
+    def query_daemon(self, prompt: str, budget: Dict[str, Any] = None, **kwargs) -> Optional[List[str]]:
+        """Ask a running daemon for kwargs["project_root"] to select context, None if there is none.
+        
+        budget is a plan_context_budget result; without one the character budget is used.
+        """
+        import socket
+        
+        socket_path = daemon_socket_path(kwargs["project_root"])
+        if not socket_path.exists():
+            return None
+        
+        request = {
+            "query": prompt,
+            "k": kwargs.get("context_files", 5),
+            "includes": kwargs.get("includes"),
+            "excludes": kwargs.get("excludes"),
+            "budget_chars": kwargs.get("context_budget") or 8000,
+            "budget_tokens": budget and budget["budget_tokens"],
+            "token_ratio": budget["token_ratio"] if budget else 1.0,
+            "respect_gitignore": kwargs.get("respect_gitignore", self.config["respect_gitignore"]),
+            "retriever": kwargs.get("retriever", self.config["retriever"]),
+            "scanner": kwargs.get("scanner", self.config["scanner"]),
+            "rerank_weights": dict(self.config["rerank_weights"], **kwargs.get("rerank_weights", {})),
+            "cwd": os.getcwd()
+        }
+        
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                # Connecting is instant when a daemon is up; the answer can take a rescan
+                sock.settimeout(1)
+                sock.connect(str(socket_path))
+                sock.settimeout(60)
+                sock.sendall((json.dumps(request) + "\n").encode())
+                with sock.makefile("rb") as reader:
+                    reply = json.loads(reader.readline() or b"{}")
+        except (OSError, ValueError):
+            return None
+        
+        if "snippets" not in reply:
+            print(f"Daemon could not serve the request ({reply.get('error', 'no reply')}); scanning locally",
+                  file=sys.stderr)
+            return None
+        return reply["snippets"]
+    
+    def build_request(self, prompt: str, memory: ProjectMemory | Workspace = None, budget: Dict[str, Any] = None,
+                      **kwargs) -> Dict[str, Any]:
+        """Build the request body, injecting project context if memory is enabled.
+        
+        kwargs["project_root"] is one root or a list of them. An open ProjectMemory (or
+        Workspace) for it may be passed as memory to be reused; otherwise one is opened and
+        closed for this request. budget is the request_budget result if the caller already
+        has it; otherwise it is planned here.
+        """
         # Merge with defaults
         request_data = {
             "prompt": prompt,
@@ -324,42 +3178,346 @@ class PerspectivesCLI:
         
         # Add project context if memory is enabled
         if request_data["project_memory"] != "none" and "project_root" in kwargs:
-            project_memory = ProjectMemory(kwargs["project_root"])
-            
-            # Get relevant snippets
-            context = project_memory.select_relevant_snippets(
-                query=prompt,
-                k=kwargs.get("context_files", 5),
-                includes=kwargs.get("includes"),
-                excludes=kwargs.get("excludes"),
-                budget_chars=kwargs.get("context_budget", 8000)
-            )
+            # An explicit character budget keeps the old behaviour; otherwise context is
+            # packed to a token budget that fits the smallest model window
+            if budget is None:
+                budget = self.request_budget(prompt, **kwargs)
+            if budget is not None and budget["budget_tokens"] <= 0:
+                if budget["room_tokens"] <= 0:
+                    print(f"Context budget exhausted: the prompt and max_tokens fill {budget['limiting_model']}'s "
+                          f"{budget['context_window']}-token window; sending the prompt without project context",
+                          file=sys.stderr)
+                else:
+                    print("Context budget is 0 tokens (context_tokens); sending the prompt without project context",
+                          file=sys.stderr)
+                return request_data
+            
+            # A daemon for this root answers from its in-memory index; otherwise scan here.
+            # Daemons serve a single root, so workspaces are always scanned here
+            roots = kwargs["project_root"]
+            snippets = None
+            if memory is None and not kwargs.get("no_daemon") and isinstance(roots, str):
+                with timings.span("daemon query"):
+                    snippets = self.query_daemon(prompt, budget=budget, **kwargs)
+            
+            if snippets is None:
+                owned = memory is None
+                with timings.span("open project memory"):
+                    project_memory = self.open_project_memory(**kwargs) if owned else memory
+                
+                # Get relevant snippets
+                try:
+                    with timings.span("select snippets"):
+                        snippets = project_memory.select_relevant_chunks(
+                            query=prompt,
+                            k=kwargs.get("context_files", 5),
+                            includes=kwargs.get("includes"),
+                            excludes=kwargs.get("excludes"),
+                            budget_chars=kwargs.get("context_budget") or 8000,
+                            budget_tokens=budget and budget["budget_tokens"],
+                            token_ratio=budget["token_ratio"] if budget else 1.0,
+                            rerank_weights=dict(self.config["rerank_weights"], **kwargs.get("rerank_weights", {}))
+                        )
+                finally:
+                    if owned:
+                        project_memory.close()
+            timings.count("context bytes", len(join_snippets(snippets).encode('utf-8')))
             
-            # Enhance the prompt with context
-            enhanced_prompt = f"Context from project:\n{context}\n\nPrompt: {prompt}"
-            request_data["prompt"] = enhanced_prompt
+            # Snippets travel by content hash, so the server can reuse ones it already holds;
+            # prepare_body folds them into the prompt for servers that can't
+            hashes = [snippet_hash(snippet) for snippet in snippets]
+            request_data["context_snippets"] = {"order": hashes, "content": dict(zip(hashes, snippets))}
             
             request_data["project_context"] = {
-                "root_path": kwargs["project_root"],
+                "root_path": roots if isinstance(roots, str) else roots[0],
                 "includes": kwargs.get("includes"),
                 "excludes": kwargs.get("excludes")
             }
+            if not isinstance(roots, str):
+                request_data["project_context"]["roots"] = list(roots)
+        
+        return request_data
+    
+    def prepare_body(self, request_data: Dict[str, Any]) -> Tuple[bytes, Dict[str, str], List[str]]:
+        """Encode request_data for the configured server as (body, extra headers, uploaded hashes).
+        
+        Servers that take context snippets by reference get only the snippets they don't
+        already hold; others get the context inlined in the prompt. The body is compressed
+        if the server advertised an encoding we can produce.
+        """
+        api_url = self.config["api_url"]
+        state = self.get_server_state()
+        
+        uploaded = []
+        snippets = request_data.get("context_snippets")
+        if snippets is not None:
+            known = state.known_snippets(api_url)
+            if known is None or len(snippets["order"]) > MAX_CONTEXT_SNIPPETS or \
+                    any(len(text.encode('utf-8')) > MAX_SNIPPET_BYTES for text in snippets["content"].values()):
+                request_data = inline_context(request_data)
+            else:
+                content = {digest: text for digest, text in snippets["content"].items() if digest not in known}
+                request_data = dict(request_data, context_snippets={"order": snippets["order"], "content": content})
+                uploaded = list(content)
+                timings.count("snippets uploaded", len(content))
+                timings.count("snippets reused", len(snippets["content"]) - len(content))
+        
+        body = json.dumps(request_data).encode('utf-8')
+        body, encoding = compress_body(body, state.encodings(api_url))
+        return body, {"Content-Encoding": encoding} if encoding else {}, uploaded
+    
+    def send_request(self, request_data: Dict[str, Any], headers: Dict[str, str],
+                     span: str = "http round trip", **kwargs) -> requests.Response:
+        """POST request_data once, renegotiating when the server rejects how it was sent.
+        
+        A 415 drops the body encoding it refused and a 409 forgets the snippets it reports
+        missing; either way the request is re-encoded and resent, at most twice. Other
+        statuses are left to the caller.
+        """
+        api_url = self.config["api_url"]
+        state = self.get_server_state()
+        
+        for renegotiations in range(3):
+            with timings.span("encode request"):
+                body, body_headers, uploaded = self.prepare_body(request_data)
+            timings.count("request bytes", len(body))
+            timings.count("http attempts")
+            with timings.span(span):
+                response = self.get_session().post(api_url, data=body, headers=dict(headers, **body_headers),
+                                                   timeout=60, **kwargs)
+            
+            # Error pages from proxies in front of the API say nothing about its capabilities
+            if response.status_code not in RETRY_STATUS_CODES:
+                state.note_headers(api_url, response.headers)
+            
+            if renegotiations == 2:
+                break
+            if response.status_code == 415 and "Content-Encoding" in body_headers:
+                state.drop_encoding(api_url, body_headers["Content-Encoding"])
+            elif response.status_code == 409:
+                try:
+                    missing = response.json().get("missing_snippets") or []
+                except ValueError:
+                    missing = []
+                if not missing:
+                    break
+                state.forget_snippets(api_url, missing)
+            else:
+                break
+            timings.count("renegotiations")
+        
+        if response.ok:
+            state.record_snippets(api_url, uploaded)
+        state.save()
+        return response
+    
+    def post_request(self, request_data: Dict[str, Any], retries: int = 0, backoff: float = 1.0) -> Dict[str, Any]:
+        """POST a request body to the API, retrying 429/5xx and connection errors.
         
-        # Make API request
+        Waits honour a numeric Retry-After header, otherwise back off exponentially
+        with jitter.
+        """
         headers = {"Content-Type": "application/json"}
         auth_token = os.getenv("POLYDEV_API_TOKEN")
         if auth_token:
             headers["Authorization"] = f"Bearer {auth_token}"
         
-        response = requests.post(
-            self.config["api_url"],
-            json=request_data,
-            headers=headers,
-            timeout=60
-        )
+        for attempt in range(retries + 1):
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            try:
+                # Re-encoded per attempt: snippets another request uploaded meanwhile needn't be resent
+                response = self.send_request(request_data, headers)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                time.sleep(delay)
+                continue
+            
+            if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else delay)
+                continue
+            
+            response.raise_for_status()
+            timings.count("response bytes", len(response.content))
+            with timings.span("decode response"):
+                return response.json()
+    
+    def call_perspectives_api(self, prompt: str, **kwargs) -> Dict[str, Any]:
+        """Call the perspectives API"""
+        # Planned once: the same budget sizes the context and is reported in the estimate
+        budget = self.request_budget(prompt, **kwargs)
+        with timings.span("build request"):
+            request_data = self.build_request(prompt, budget=budget, **kwargs)
+        
+        cache_key, response = self.lookup_response(request_data, **kwargs)
+        if response is not None:
+            renderer = kwargs.get("renderer")
+            if renderer:
+                for resp in response.get("responses", []):
+                    renderer.on_model(resp)
+                renderer.finish()
+        elif kwargs.get("stream"):
+            response = self.stream_request(request_data, renderer=kwargs.get("renderer"))
+            if cache_key:
+                self.get_response_cache().put(cache_key, response)
+        else:
+            response = self.fetch_response(request_data, retries=kwargs.get("retries", 0), cache_key=cache_key)
+        
+        response["token_estimate"] = self.estimate_request_tokens(request_data,
+                                                                  budget if request_data.get("project_context") else None)
+        return response
+    
+    @staticmethod
+    def iter_events(response: requests.Response) -> Iterator[Tuple[str, str]]:
+        """Parse a server-sent event stream into (event, data) pairs"""
+        event, data = "message", []
+        response.encoding = "utf-8"
+        # chunk_size=None yields data as it arrives instead of waiting to fill a buffer
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line:
+                if data:
+                    yield event, "\n".join(data)
+                event, data = "message", []
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].lstrip())
+        if data:
+            yield event, "\n".join(data)
+    
+    def stream_request(self, request_data: Dict[str, Any], renderer: "StreamRenderer" = None) -> Dict[str, Any]:
+        """POST a request in streaming mode, feeding tokens to renderer as they arrive.
+        
+        Returns the same response shape as post_request, plus client-measured
+        time_to_first_token_ms overall and per model. Falls back to a plain JSON body
+        if the server doesn't stream.
+        """
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        auth_token = os.getenv("POLYDEV_API_TOKEN")
+        if auth_token:
+            headers["Authorization"] = f"Bearer {auth_token}"
         
+        start_time = time.monotonic()
+        response = self.send_request(dict(request_data, stream=True), headers, span="http response headers",
+                                     stream=True)
         response.raise_for_status()
-        return response.json()
+        
+        first_token = {}
+        result = None
+        
+        if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+            result = response.json()
+            events = [("model", resp) for resp in result.get("responses", [])]
+        else:
+            events = ((event, json.loads(data)) for event, data in self.iter_events(response))
+        
+        with timings.span("stream body"):
+            for event, payload in events:
+                if event == "token":
+                    first_token.setdefault(payload["model"], int((time.monotonic() - start_time) * 1000))
+                    if renderer:
+                        renderer.on_token(payload["model"], payload["content"])
+                elif event == "model":
+                    if renderer:
+                        renderer.on_model(payload)
+                elif event == "done":
+                    result = payload
+                elif event == "error":
+                    raise RuntimeError(payload.get("error", "Streaming request failed"))
+        
+        if result is None:
+            raise RuntimeError("Stream ended before the final response")
+        
+        for resp in result.get("responses", []):
+            if resp.get("model") in first_token:
+                resp["time_to_first_token_ms"] = first_token[resp["model"]]
+        result["time_to_first_token_ms"] = min(first_token.values()) if first_token else None
+        
+        if renderer:
+            renderer.finish()
+        return result
+    
+    def run_batch(self, lines, concurrency: int = 4, retries: int = 3, output=None, **kwargs) -> int:
+        """Send prompts from JSONL lines concurrently and stream results as JSONL.
+        
+        Each input line is an object with a "prompt" and optionally an "id" plus any
+        request option (models, temperature, project_root, ...) overriding kwargs.
+        Results are written in completion order as {"id", "response"} or {"id", "error"}.
+        Context selection runs on the calling thread while earlier requests are in
+        flight; only the HTTP round trips are concurrent. Returns the number of failures.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        
+        output = output or sys.stdout
+        self.get_session(pool_size=concurrency)
+        project_memories = {}
+        failures = 0
+        
+        def emit(record):
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = {}
+            
+            def drain(block_until: int):
+                nonlocal failures
+                while len(in_flight) > block_until:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item_id = in_flight.pop(future)
+                        try:
+                            emit({"id": item_id, "response": future.result()})
+                        except Exception as e:
+                            failures += 1
+                            emit({"id": item_id, "error": str(e)})
+            
+            try:
+                for line_number, line in enumerate(lines, 1):
+                    if not line.strip():
+                        continue
+                    
+                    item_id = line_number
+                    try:
+                        item = json.loads(line)
+                        if not isinstance(item, dict) or not item.get("prompt"):
+                            raise ValueError("expected a JSON object with a \"prompt\"")
+                        item_id = item.get("id", line_number)
+                        
+                        item_kwargs = dict(kwargs)
+                        item_kwargs.update({key: value for key, value in item.items() if key not in ("id", "prompt")})
+                        
+                        memory = None
+                        root = item_kwargs.get("project_root")
+                        if root and item_kwargs.get("project_memory", self.config["project_memory"]) != "none":
+                            # A workspace is reused for the same roots, in the same order
+                            root = root if isinstance(root, str) else tuple(root)
+                            if root not in project_memories:
+                                project_memories[root] = self.open_project_memory(**item_kwargs)
+                            memory = project_memories[root]
+                        
+                        request_data = self.build_request(item["prompt"], memory=memory, **item_kwargs)
+                        cache_key, response = self.lookup_response(request_data, **item_kwargs)
+                    except Exception as e:
+                        failures += 1
+                        emit({"id": item_id, "error": str(e)})
+                        continue
+                    
+                    if response is not None:
+                        emit({"id": item_id, "response": response})
+                        continue
+                    
+                    # Bound the queue so a large input doesn't build every request up front
+                    drain(2 * concurrency - 1)
+                    in_flight[pool.submit(self.fetch_response, request_data, retries, cache_key)] = item_id
+                
+                drain(0)
+            finally:
+                for project_memory in project_memories.values():
+                    project_memory.close()
+        
+        return failures
     
     def format_response(self, response: Dict[str, Any]) -> str:
         """Format API response for display"""
@@ -368,6 +3526,10 @@ class PerspectivesCLI:
         lines.append(f"PERSPECTIVES RESPONSE")
         lines.append(f"Total Tokens: {response.get('total_tokens', 'N/A')}")
         lines.append(f"Total Latency: {response.get('total_latency_ms', 'N/A')}ms")
+        if response.get('time_to_first_token_ms') is not None:
+            lines.append(f"Time to First Token: {response['time_to_first_token_ms']}ms")
+        if response.get('cached'):
+            lines.append("Cached: yes")
         lines.append("=" * 80)
         
         for i, resp in enumerate(response.get('responses', []), 1):
@@ -381,31 +3543,386 @@ class PerspectivesCLI:
             
             if resp.get('tokens_used'):
                 lines.append(f"\nTokens: {resp['tokens_used']}, Latency: {resp.get('latency_ms', 0)}ms")
+            if resp.get('time_to_first_token_ms') is not None:
+                lines.append(f"First Token: {resp['time_to_first_token_ms']}ms")
         
         return "\n".join(lines)
 
+class StreamRenderer:
+    """Prints streamed tokens as contiguous per-model sections.
+    
+    Models stream in parallel, so one section is live at a time: the first model to
+    produce a token is printed as it arrives while the others are buffered, and when
+    the live model finishes the next one is flushed and followed live.
+    """
+    
+    def __init__(self, output=None):
+        self.output = output or sys.stdout
+        self.live = None
+        self.buffers = {}  # model -> buffered text, in order of first token
+        self.finished = {}  # model -> final ModelResponse
+        self.sections = 0
+        self.write("=" * 80 + "\nPERSPECTIVES RESPONSE (streaming)\n" + "=" * 80 + "\n")
+    
+    def write(self, text: str):
+        self.output.write(text)
+        self.output.flush()
+    
+    def open_section(self, model: str):
+        self.sections += 1
+        self.write(f"\n{self.sections}. {model}\n" + "-" * 40 + "\n")
+    
+    def close_section(self, resp: Dict[str, Any]):
+        if resp.get('error'):
+            self.write(f"\nERROR: {resp['error']}")
+        stats = [f"Tokens: {resp.get('tokens_used', 'N/A')}", f"Latency: {resp.get('latency_ms', 0)}ms"]
+        self.write("\n\n" + ", ".join(stats) + "\n")
+    
+    def on_token(self, model: str, text: str):
+        if self.live is None and model not in self.finished:
+            self.live = model
+            self.open_section(model)
+            self.write("".join(self.buffers.pop(model, [])))
+        
+        if model == self.live:
+            self.write(text)
+        else:
+            self.buffers.setdefault(model, []).append(text)
+    
+    def on_model(self, resp: Dict[str, Any]):
+        model = resp.get('model')
+        self.finished[model] = resp
+        
+        if model == self.live:
+            self.close_section(resp)
+            self.live = None
+        elif model not in self.buffers:
+            # Finished without streaming anything (an error or a non-streaming provider)
+            self.buffers[model] = [resp.get('content') or ""]
+        
+        if self.live is None:
+            self.advance()
+    
+    def advance(self):
+        """Flush buffered models in order until one is still streaming, which becomes live"""
+        for model in list(self.buffers):
+            self.open_section(model)
+            self.write("".join(self.buffers.pop(model)))
+            if model not in self.finished:
+                self.live = model
+                return
+            self.close_section(self.finished[model])
+    
+    def finish(self):
+        self.advance()
+
+def load_workspace(path: str) -> List[str]:
+    """Project roots listed in a workspace file, relative ones resolved against its directory.
+    
+    The file is JSON: a list of paths, or an object whose "folders" are [{"path": ...}, ...]
+    as in a VS Code .code-workspace file.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    
+    folders = data.get("folders") if isinstance(data, dict) else data
+    if not isinstance(folders, list):
+        raise ValueError(f"{path}: expected a list of roots or an object with \"folders\"")
+    
+    base = Path(path).resolve().parent
+    roots = []
+    for folder in folders:
+        root = folder.get("path") if isinstance(folder, dict) else folder
+        if not isinstance(root, str):
+            raise ValueError(f"{path}: invalid root {folder!r}")
+        roots.append(str(base / os.path.expanduser(root)))
+    return roots
+
+def add_request_arguments(parser: argparse.ArgumentParser):
+    """Request options shared by the get and batch commands"""
+    parser.add_argument('--models', nargs='+', help='Models to query')
+    parser.add_argument('--mode', choices=['managed', 'byo'], help='API key mode')
+    parser.add_argument('--memory', choices=['none', 'light', 'full'], 
+                        help='Project memory level')
+    parser.add_argument('--project-root', action='append',
+                        help='Project root directory; repeat to index and query several roots as one workspace')
+    parser.add_argument('--workspace', metavar='FILE',
+                        help='JSON file listing project roots (a list of paths, or a .code-workspace file)')
+    parser.add_argument('--includes', nargs='+', help='File patterns to include')
+    parser.add_argument('--excludes', nargs='+', help='File patterns to exclude')
+    parser.add_argument('--respect-gitignore', action='store_true',
+                        help='Skip files ignored by .gitignore when scanning the project')
+    parser.add_argument('--scanner', choices=ProjectMemory.SCANNERS,
+                        help='How to list project files: walk the tree, or read the git index (default: scanner)')
+    parser.add_argument('--jobs', type=int,
+                        help='Threads for reading and hashing project files')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Worker processes for tokenizing changed files (0 = in-process)')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='Scan the project here even if a daemon is serving it')
+    parser.add_argument('--context-files', type=int, default=5, 
+                        help='Number of context files to include')
+    parser.add_argument('--context-tokens', type=int,
+                        help='Token budget for context, capped to fit the smallest requested model window '
+                             '(default: context_tokens)')
+    parser.add_argument('--context-budget', type=int,
+                        help='Character budget for context, instead of a token budget')
+    parser.add_argument('--rerank-weights', type=parse_weights, metavar='NAME=WEIGHT,...',
+                        help='Weights for re-ranking context by recency, locality and size, '
+                             'e.g. recency=0.5,size=0 (default: rerank_weights)')
+    parser.add_argument('--temperature', type=float, help='Model temperature')
+    parser.add_argument('--max-tokens', type=int, help='Max tokens per response')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Neither use nor store responses in the local response cache')
+    parser.add_argument('--cache-ttl', type=float, metavar='SECONDS',
+                        help='Only reuse cached responses younger than this (default: response_cache_ttl)')
+
+def build_request_kwargs(args: argparse.Namespace) -> Dict[str, Any]:
+    """Turn parsed request options into call_perspectives_api kwargs"""
+    kwargs = {}
+    if args.models:
+        kwargs['models'] = args.models
+    if args.mode:
+        kwargs['mode'] = args.mode
+    if args.memory:
+        kwargs['project_memory'] = args.memory
+    roots = list(args.project_root or [])
+    if args.workspace:
+        roots += load_workspace(args.workspace)
+    if roots:
+        kwargs['project_root'] = roots[0] if len(roots) == 1 else roots
+    if args.includes:
+        kwargs['includes'] = args.includes
+    if args.excludes:
+        kwargs['excludes'] = args.excludes
+    if args.respect_gitignore:
+        kwargs['respect_gitignore'] = True
+    if args.scanner:
+        kwargs['scanner'] = args.scanner
+    if args.jobs:
+        kwargs['jobs'] = args.jobs
+    if args.processes:
+        kwargs['processes'] = args.processes
+    if args.no_daemon:
+        kwargs['no_daemon'] = True
+    if args.temperature is not None:
+        kwargs['temperature'] = args.temperature
+    if args.max_tokens:
+        kwargs['max_tokens'] = args.max_tokens
+    if args.no_cache:
+        kwargs['no_cache'] = True
+    if args.cache_ttl is not None:
+        kwargs['cache_ttl'] = args.cache_ttl
+    
+    kwargs['context_files'] = args.context_files
+    if args.context_tokens is not None:
+        kwargs['context_tokens'] = args.context_tokens
+    if args.context_budget:
+        kwargs['context_budget'] = args.context_budget
+    if args.rerank_weights:
+        kwargs['rerank_weights'] = args.rerank_weights
+    return kwargs
+
+def daemon_socket_path(project_root: str) -> Path:
+    """Unix socket the daemon for project_root listens on"""
+    root = str(Path(project_root).resolve())
+    return Path.home() / ".polydev" / "daemon" / f"{hashlib.sha1(root.encode()).hexdigest()[:16]}.sock"
+
+def run_daemon(cli: PerspectivesCLI, args: argparse.Namespace):
+    """Serve snippet selection for one project root over a Unix socket until interrupted.
+    
+    Requests and responses are single lines of JSON: {"query", "k", "includes", "excludes",
+    "budget_chars", "budget_tokens", "token_ratio", "rerank_weights", "cwd", "respect_gitignore", "retriever",
+    "scanner"} in,
+    {"snippets"} or {"error"} out.
+    """
+    import signal
+    import socket
+    import socketserver
+    
+    root = Path(args.project_root).resolve()
+    socket_path = daemon_socket_path(str(root))
+    socket_path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+    
+    if socket_path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(socket_path))
+            raise RuntimeError(f"A daemon is already serving {root} on {socket_path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that didn't shut down cleanly
+            socket_path.unlink(missing_ok=True)
+        finally:
+            probe.close()
+    
+    respect_gitignore = args.respect_gitignore or cli.config["respect_gitignore"]
+    memory = WarmProjectMemory(str(root), respect_gitignore=respect_gitignore, jobs=args.jobs,
+                               processes=args.processes, retriever=cli.config["retriever"],
+                               max_cache_bytes=cli.config["cache_max_bytes"],
+                               max_cache_entries=cli.config["cache_max_entries"],
+                               scanner=args.scanner or cli.config["scanner"])
+    
+    # Every file outside the excluded directories is watched, whatever a query includes
+    watch_matcher = compile_matcher(("**/*",), tuple(args.excludes or memory.default_excludes))
+    watcher = ProjectWatcher(memory, watch_matcher, memory.invalidate, poll_interval=args.poll_interval,
+                             force_polling=args.poll)
+    
+    # The memory isn't safe to query from two threads at once
+    query_lock = threading.Lock()
+    
+    class Handler(socketserver.StreamRequestHandler):
+        timeout = DAEMON_READ_TIMEOUT
+        
+        def handle(self):
+            try:
+                for line in self.rfile:
+                    self.wfile.write((json.dumps(self.answer(line)) + "\n").encode())
+                    self.wfile.flush()
+            except OSError:
+                pass  # Timed out waiting for a request, or the client went away
+        
+        def answer(self, line: bytes) -> Dict[str, Any]:
+            try:
+                request = json.loads(line)
+                if bool(request.get("respect_gitignore")) != respect_gitignore or \
+                        request.get("retriever", memory.retriever) != memory.retriever or \
+                        request.get("scanner", memory.scanner) != memory.scanner:
+                    raise ValueError("request options differ from the daemon's")
+                
+                with query_lock:
+                    start = time.perf_counter()
+                    snippets = memory.select_relevant_chunks(
+                        query=request["query"],
+                        k=request.get("k", 5),
+                        includes=request.get("includes"),
+                        excludes=request.get("excludes"),
+                        budget_chars=request.get("budget_chars", 8000),
+                        budget_tokens=request.get("budget_tokens"),
+                        token_ratio=request.get("token_ratio", 1.0),
+                        rerank_weights=request.get("rerank_weights"),
+                        cwd=request.get("cwd")
+                    )
+                return {"snippets": snippets, "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)}
+            except Exception as e:
+                return {"error": str(e)}
+    
+    # Each connection is read on its own thread, so a client that connects and sends nothing
+    # holds up no one else; the queries themselves still run one at a time under query_lock
+    server = socketserver.ThreadingUnixStreamServer(str(socket_path), Handler)
+    server.daemon_threads = True
+    os.chmod(socket_path, 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    # Marks the partition as in use, so `cache prune` elsewhere leaves it alone
+    pid_path = memory.cache_dir / "daemon.pid"
+    pid_path.write_text(str(os.getpid()))
+    
+    try:
+        # Warm the index for the default file set before accepting queries
+        memory.build_indexed_corpus(args.includes, args.excludes)
+        method = watcher.start()
+        print(f"Serving {root} on {socket_path} (watching with {method})", file=sys.stderr)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        pid_path.unlink(missing_ok=True)
+        memory.close()
+
+def profile_startup(budget_ms: float = STARTUP_BUDGET_MS) -> int:
+    """Report where CLI startup time goes; returns 1 if importing the module exceeds the budget.
+    
+    Runs `python -X importtime` on this module in a fresh interpreter and times a
+    `config --list` invocation end to end.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = Path(__file__).stem
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {module_dir!r}); import {module_name}"],
+        capture_output=True, text=True
+    )
+    
+    # Lines look like "import time:  self [us] |  cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+        if len(parts) == 3 and parts[0].strip().isdigit():
+            imports.append((int(parts[0]), int(parts[1]), parts[2].strip()))
+    
+    module_ms = next((cumulative for _, cumulative, name in imports if name == module_name), 0) / 1000
+    heavy = sorted({name.split(".")[0] for _, _, name in imports} & {"numpy", "scipy", "sklearn", "requests"})
+    
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.abspath(__file__), "config", "--list"], capture_output=True)
+    command_ms = (time.perf_counter() - start) * 1000
+    
+    print(f"Module import: {module_ms:.1f}ms (budget {budget_ms:.0f}ms)")
+    print(f"'config --list' end to end: {command_ms:.1f}ms (including interpreter start-up)")
+    print(f"Heavy dependencies imported at startup: {', '.join(heavy) or 'none'}")
+    print("\nSlowest imports (self time):")
+    for self_us, cumulative_us, name in sorted(imports, reverse=True)[:15]:
+        print(f"  {self_us / 1000:8.1f}ms  {cumulative_us / 1000:8.1f}ms cumulative  {name.strip()}")
+    
+    return 1 if module_ms > budget_ms else 0
+
 def main():
     parser = argparse.ArgumentParser(description="Polydev Perspectives CLI")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report where startup time goes and exit non-zero if the import budget is exceeded')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
     
     # Get perspectives command
     perspectives_parser = subparsers.add_parser('get', help='Get perspectives on a prompt')
     perspectives_parser.add_argument('prompt', help='The prompt to get perspectives on')
-    perspectives_parser.add_argument('--models', nargs='+', help='Models to query')
-    perspectives_parser.add_argument('--mode', choices=['managed', 'byo'], help='API key mode')
-    perspectives_parser.add_argument('--memory', choices=['none', 'light', 'full'], 
-                                   help='Project memory level')
-    perspectives_parser.add_argument('--project-root', help='Project root directory')
-    perspectives_parser.add_argument('--includes', nargs='+', help='File patterns to include')
-    perspectives_parser.add_argument('--excludes', nargs='+', help='File patterns to exclude')
-    perspectives_parser.add_argument('--context-files', type=int, default=5, 
-                                   help='Number of context files to include')
-    perspectives_parser.add_argument('--context-budget', type=int, default=8000,
-                                   help='Character budget for context')
-    perspectives_parser.add_argument('--temperature', type=float, help='Model temperature')
-    perspectives_parser.add_argument('--max-tokens', type=int, help='Max tokens per response')
+    add_request_arguments(perspectives_parser)
     perspectives_parser.add_argument('--output', choices=['json', 'text'], default='text',
                                    help='Output format')
+    perspectives_parser.add_argument('--stream', action='store_true',
+                                   help='Print each model\'s tokens as they arrive')
+    perspectives_parser.add_argument('--timings', action='store_true',
+                                   help='Print a per-stage timing breakdown and counters to stderr')
+    perspectives_parser.add_argument('--timings-file', metavar='PATH',
+                                   help='Also write the timings to PATH')
+    perspectives_parser.add_argument('--timings-format', choices=['json', 'chrome'], default='json',
+                                   help='Format for --timings-file (chrome: Trace Event Format for chrome://tracing)')
+    
+    # Batch command
+    batch_parser = subparsers.add_parser('batch', help='Get perspectives on many prompts concurrently')
+    batch_parser.add_argument('input', nargs='?', default='-',
+                            help='JSONL file of {"id", "prompt", ...options} objects (default: stdin)')
+    add_request_arguments(batch_parser)
+    batch_parser.add_argument('--concurrency', type=int, default=4, help='Maximum requests in flight')
+    batch_parser.add_argument('--retries', type=int, default=3,
+                            help='Retries per prompt on 429/5xx responses and connection errors')
+    
+    # Daemon command
+    daemon_parser = subparsers.add_parser('daemon', help='Keep a project index in memory and serve context to get')
+    daemon_parser.add_argument('--project-root', default='.', help='Project root directory')
+    daemon_parser.add_argument('--includes', nargs='+', help='File patterns to index up front')
+    daemon_parser.add_argument('--excludes', nargs='+', help='File patterns to exclude (also not watched)')
+    daemon_parser.add_argument('--respect-gitignore', action='store_true',
+                               help='Skip files ignored by .gitignore when scanning the project')
+    daemon_parser.add_argument('--scanner', choices=ProjectMemory.SCANNERS,
+                               help='How to list project files: walk the tree, or read the git index '
+                                    '(default: scanner)')
+    daemon_parser.add_argument('--jobs', type=int, help='Threads for reading and hashing project files')
+    daemon_parser.add_argument('--processes', type=int, default=0,
+                               help='Worker processes for tokenizing changed files (0 = in-process)')
+    daemon_parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify')
+    daemon_parser.add_argument('--poll-interval', type=float, default=2.0,
+                               help='Seconds between polls when polling')
+    
+    # Cache command
+    cache_parser = subparsers.add_parser('cache', help='Inspect or shrink the project memory cache')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    cache_subparsers.add_parser('stats', help='Show per-project cache usage')
+    prune_parser = cache_subparsers.add_parser('prune', help='Drop deleted projects and least recently used projects down to the caps')
+    prune_parser.add_argument('--max-bytes', type=parse_size,
+                              help='Byte cap across all projects, e.g. 512M (default: cache_max_bytes)')
+    prune_parser.add_argument('--max-entries', type=int,
+                              help='File entry cap across all projects (default: cache_max_entries)')
     
     # Config command
     config_parser = subparsers.add_parser('config', help='Manage configuration')
@@ -423,6 +3940,9 @@ def main():
     
     args = parser.parse_args()
     
+    if args.profile_startup:
+        sys.exit(profile_startup())
+    
     if not args.command:
         parser.print_help()
         return
@@ -431,35 +3951,78 @@ def main():
     
     try:
         if args.command == 'get':
-            # Build kwargs from args
-            kwargs = {}
-            if args.models:
-                kwargs['models'] = args.models
-            if args.mode:
-                kwargs['mode'] = args.mode
-            if args.memory:
-                kwargs['project_memory'] = args.memory
-            if args.project_root:
-                kwargs['project_root'] = args.project_root
-            if args.includes:
-                kwargs['includes'] = args.includes
-            if args.excludes:
-                kwargs['excludes'] = args.excludes
-            if args.temperature is not None:
-                kwargs['temperature'] = args.temperature
-            if args.max_tokens:
-                kwargs['max_tokens'] = args.max_tokens
-            
-            kwargs['context_files'] = args.context_files
-            kwargs['context_budget'] = args.context_budget
-            
-            response = cli.call_perspectives_api(args.prompt, **kwargs)
+            kwargs = build_request_kwargs(args)
+            if args.stream:
+                kwargs['stream'] = True
+                if args.output == 'text':
+                    kwargs['renderer'] = StreamRenderer()
+            
+            timings.enabled = args.timings or bool(args.timings_file)
+            try:
+                with timings.span("get"):
+                    response = cli.call_perspectives_api(args.prompt, **kwargs)
+            finally:
+                if args.timings:
+                    print(timings.report(), file=sys.stderr)
+                if args.timings_file:
+                    timings.export(args.timings_file, args.timings_format)
             
             if args.output == 'json':
                 print(json.dumps(response, indent=2))
+            elif args.stream:
+                print("=" * 80)
+                print(f"Total Tokens: {response.get('total_tokens', 'N/A')}")
+                print(f"Total Latency: {response.get('total_latency_ms', 'N/A')}ms")
+                if response.get('time_to_first_token_ms') is not None:
+                    print(f"Time to First Token: {response['time_to_first_token_ms']}ms")
             else:
                 print(cli.format_response(response))
         
+        elif args.command == 'batch':
+            kwargs = build_request_kwargs(args)
+            
+            if args.input == '-':
+                failures = cli.run_batch(sys.stdin, concurrency=args.concurrency, retries=args.retries, **kwargs)
+            else:
+                with open(args.input) as f:
+                    failures = cli.run_batch(f, concurrency=args.concurrency, retries=args.retries, **kwargs)
+            
+            if failures:
+                print(f"{failures} prompt(s) failed", file=sys.stderr)
+                sys.exit(1)
+        
+        elif args.command == 'daemon':
+            run_daemon(cli, args)
+        
+        elif args.command == 'cache':
+            cache_root = Path(os.path.expanduser("~/.polydev/cache"))
+            
+            if args.cache_command == 'stats':
+                partitions = sorted(cache_partitions(cache_root), key=lambda p: p['last_accessed'], reverse=True)
+                for partition in partitions:
+                    last_used = datetime.fromtimestamp(partition['last_accessed']).strftime('%Y-%m-%d %H:%M')
+                    served = f"  (daemon pid {partition['daemon']})" if partition['daemon'] else ""
+                    print(f"{format_bytes(partition['bytes']):>10}  {partition['entries']:>7} entries  "
+                          f"last used {last_used}  {partition['root'] or partition['dir'].name}{served}")
+                print(f"{format_bytes(sum(p['bytes'] for p in partitions)):>10}  "
+                      f"{sum(p['entries'] for p in partitions):>7} entries  in {len(partitions)} project(s) "
+                      f"(caps: {format_bytes(cli.config['cache_max_bytes'])}, {cli.config['cache_max_entries']} entries)")
+                
+                entries, size = cli.get_response_cache().stats()
+                print(f"{format_bytes(size):>10}  {entries:>7} responses  "
+                      f"(TTL {cli.config['response_cache_ttl']}s, cap {format_bytes(cli.config['response_cache_max_bytes'])})")
+            
+            elif args.cache_command == 'prune':
+                max_bytes = args.max_bytes if args.max_bytes is not None else cli.config["cache_max_bytes"]
+                max_entries = args.max_entries if args.max_entries is not None else cli.config["cache_max_entries"]
+                actions = prune_cache(cache_root, max_bytes, max_entries)
+                response_cache = cli.get_response_cache()
+                with response_cache.conn:
+                    removed = response_cache.prune()
+                if removed:
+                    actions.append(f"Removed {removed} expired or least recently used cached responses")
+                print("\n".join(actions) if actions else "Cache is within its caps; nothing to prune")
+        
         elif args.command == 'config':
             if args.set:
                 key, value = args.set
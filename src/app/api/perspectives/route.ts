@@ -1,5 +1,15 @@
 import { NextRequest, NextResponse } from 'next/server'
+import { createHash } from 'crypto'
+import * as zlib from 'zlib'
 import { createClient } from '../../utils/supabase/server'
+import { cache } from '@/lib/redis'
+
+// Project context as content-addressed snippets: `order` lists snippet hashes (SHA-256 of
+// the UTF-8 text) and `content` carries only the texts this server may not hold yet
+interface ContextSnippets {
+  order: string[]
+  content?: Record<string, string>
+}
 
 interface GetPerspectivesRequest {
   prompt: string
@@ -10,11 +20,14 @@ interface GetPerspectivesRequest {
   max_messages?: number
   temperature?: number
   max_tokens?: number
+  stream?: boolean
   project_context?: {
     root_path?: string
+    roots?: string[]
     includes?: string[]
     excludes?: string[]
   }
+  context_snippets?: ContextSnippets
 }
 
 interface ModelResponse {
@@ -32,6 +45,13 @@ interface PerspectivesResponse {
   cached?: boolean
 }
 
+type TokenHandler = (text: string) => void
+
+interface ModelCall {
+  model: string
+  call: (onToken?: TokenHandler) => Promise<ModelResponse>
+}
+
 // Default model configurations
 const DEFAULT_MODELS = [
   'gpt-4',
@@ -39,6 +59,130 @@ const DEFAULT_MODELS = [
   'gemini-pro'
 ]
 
+// Request body encodings we can decode, advertised on every response (RFC 7694) so
+// clients know they may compress; zstd needs a Node.js build with zlib zstd support
+const REQUEST_DECODERS: Record<string, (data: Buffer) => Buffer> = {
+  gzip: data => zlib.gunzipSync(data),
+  deflate: data => zlib.inflateSync(data),
+  br: data => zlib.brotliDecompressSync(data),
+  ...('zstdDecompressSync' in zlib ? { zstd: (data: Buffer) => (zlib as any).zstdDecompressSync(data) } : {})
+}
+
+// How long uploaded context snippets stay referenceable by hash
+const SNIPPET_TTL_SECONDS = 24 * 60 * 60
+
+// Caps on context_snippets, so one request can't make the server hold unbounded text
+const MAX_CONTEXT_SNIPPETS = 256
+const MAX_SNIPPET_BYTES = 128 * 1024
+
+// Filled in by handlePerspectives once the caller is known
+interface RequestSession {
+  userId: string | null
+}
+
+// Parse the JSON body, decoding any Content-Encoding; null if the encoding isn't supported
+async function readRequestBody(request: NextRequest): Promise<GetPerspectivesRequest | null> {
+  const encoding = (request.headers.get('content-encoding') || 'identity').trim().toLowerCase()
+  let data = Buffer.from(await request.arrayBuffer())
+
+  if (encoding !== 'identity') {
+    const decode = REQUEST_DECODERS[encoding]
+    if (!decode) {
+      return null
+    }
+    data = decode(data)
+  }
+
+  return JSON.parse(data.toString('utf-8'))
+}
+
+// Why a context_snippets payload is refused, if it is: malformed or over the caps
+function checkContextSnippets(snippets: ContextSnippets): { status: number, error: string } | null {
+  const content = snippets.content ?? {}
+  if (!Array.isArray(snippets.order) || snippets.order.some(hash => typeof hash !== 'string') ||
+      typeof content !== 'object' || content === null) {
+    return { status: 400, error: 'Invalid context_snippets' }
+  }
+
+  const texts = Object.values(content)
+  if (snippets.order.length > MAX_CONTEXT_SNIPPETS || texts.length > MAX_CONTEXT_SNIPPETS) {
+    return { status: 413, error: `Too many context snippets (at most ${MAX_CONTEXT_SNIPPETS})` }
+  }
+  if (texts.some(text => typeof text !== 'string' || Buffer.byteLength(text, 'utf8') > MAX_SNIPPET_BYTES)) {
+    return { status: 413, error: `Context snippets must be strings of at most ${MAX_SNIPPET_BYTES} bytes` }
+  }
+  return null
+}
+
+// Resolve snippet hashes to texts. With a scope (an authenticated user's id), newly uploaded
+// snippets are stored under it for later requests, so a hash alone never reveals someone
+// else's code; without one nothing is stored or looked up, and every text must be sent.
+async function resolveContextSnippets(snippets: ContextSnippets, scope: string | null): Promise<{ texts?: string[], missing?: string[], invalid?: string }> {
+  const texts = new Map<string, string>()
+
+  for (const [hash, text] of Object.entries(snippets.content || {})) {
+    if (createHash('sha256').update(text, 'utf8').digest('hex') !== hash) {
+      return { invalid: hash }
+    }
+    texts.set(hash, text)
+  }
+  if (scope) {
+    await Promise.all(Array.from(texts, ([hash, text]) => cache.set(`snippet:${scope}:${hash}`, text, SNIPPET_TTL_SECONDS)))
+  }
+
+  const unknown = Array.from(new Set(snippets.order)).filter(hash => !texts.has(hash))
+  const stored = scope ? await Promise.all(unknown.map(hash => cache.get<string>(`snippet:${scope}:${hash}`))) : []
+  const missing = unknown.filter((hash, i) => {
+    const text = stored[i]
+    if (typeof text !== 'string') {
+      return true
+    }
+    texts.set(hash, text)
+    return false
+  })
+
+  if (missing.length > 0) {
+    return { missing }
+  }
+  return { texts: snippets.order.map(hash => texts.get(hash)!) }
+}
+
+// The context block as the CLI used to inline it, so prompts are identical either way
+function joinSnippets(texts: string[]): string {
+  return texts.length > 0 ? '\n' + '='.repeat(80) + texts.join('\n') : 'No files found in project.'
+}
+
+// Read a server-sent event stream, handing each `data:` payload to onData
+async function readEventStream(response: Response, onData: (data: string) => void) {
+  if (!response.body) {
+    return
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+
+  while (true) {
+    const { done, value } = await reader.read()
+    if (done) {
+      break
+    }
+
+    buffer += decoder.decode(value, { stream: true })
+    const lines = buffer.split('\n')
+    buffer = lines.pop() || ''
+
+    for (const line of lines) {
+      if (line.startsWith('data:')) {
+        const data = line.slice(5).trim()
+        if (data && data !== '[DONE]') {
+          onData(data)
+        }
+      }
+    }
+  }
+}
+
 async function callOpenAI(prompt: string, apiKey: string, model: string = 'gpt-4', options: any = {}) {
   const startTime = Date.now()
   
@@ -53,10 +197,28 @@ async function callOpenAI(prompt: string, apiKey: string, model: string = 'gpt-4
         model,
         messages: [{ role: 'user', content: prompt }],
         temperature: options.temperature || 0.7,
-        max_tokens: options.max_tokens || 2000
+        max_tokens: options.max_tokens || 2000,
+        ...(options.onToken ? { stream: true, stream_options: { include_usage: true } } : {})
       })
     })
 
+    if (options.onToken && response.ok) {
+      let content = ''
+      let tokensUsed: number | undefined
+      await readEventStream(response, data => {
+        const chunk = JSON.parse(data)
+        const text = chunk.choices?.[0]?.delta?.content
+        if (text) {
+          content += text
+          options.onToken(text)
+        }
+        if (chunk.usage) {
+          tokensUsed = chunk.usage.total_tokens
+        }
+      })
+      return { model, content, tokens_used: tokensUsed, latency_ms: Date.now() - startTime }
+    }
+
     const data = await response.json()
     const endTime = Date.now()
 
@@ -95,10 +257,28 @@ async function callAnthropic(prompt: string, apiKey: string, model: string = 'cl
         model,
         max_tokens: options.max_tokens || 2000,
         temperature: options.temperature || 0.7,
-        messages: [{ role: 'user', content: prompt }]
+        messages: [{ role: 'user', content: prompt }],
+        ...(options.onToken ? { stream: true } : {})
       })
     })
 
+    if (options.onToken && response.ok) {
+      let content = ''
+      let tokensUsed = 0
+      await readEventStream(response, data => {
+        const event = JSON.parse(data)
+        if (event.type === 'content_block_delta' && event.delta?.text) {
+          content += event.delta.text
+          options.onToken(event.delta.text)
+        } else if (event.type === 'message_start') {
+          tokensUsed += event.message?.usage?.input_tokens || 0
+        } else if (event.type === 'message_delta') {
+          tokensUsed += event.usage?.output_tokens || 0
+        }
+      })
+      return { model, content, tokens_used: tokensUsed, latency_ms: Date.now() - startTime }
+    }
+
     const data = await response.json()
     const endTime = Date.now()
 
@@ -126,7 +306,8 @@ async function callGemini(prompt: string, apiKey: string, model: string = 'gemin
   const startTime = Date.now()
   
   try {
-    const response = await fetch(`https://generativelanguage.googleapis.com/v1beta/models/${model}:generateContent?key=${apiKey}`, {
+    const endpoint = options.onToken ? 'streamGenerateContent?alt=sse&' : 'generateContent?'
+    const response = await fetch(`https://generativelanguage.googleapis.com/v1beta/models/${model}:${endpoint}key=${apiKey}`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json'
@@ -142,6 +323,23 @@ async function callGemini(prompt: string, apiKey: string, model: string = 'gemin
       })
     })
 
+    if (options.onToken && response.ok) {
+      let content = ''
+      let tokensUsed: number | undefined
+      await readEventStream(response, data => {
+        const chunk = JSON.parse(data)
+        const text = chunk.candidates?.[0]?.content?.parts?.[0]?.text
+        if (text) {
+          content += text
+          options.onToken(text)
+        }
+        if (chunk.usageMetadata) {
+          tokensUsed = chunk.usageMetadata.totalTokenCount
+        }
+      })
+      return { model, content, tokens_used: tokensUsed, latency_ms: Date.now() - startTime }
+    }
+
     const data = await response.json()
     const endTime = Date.now()
 
@@ -179,10 +377,28 @@ async function callOpenAICompatible(prompt: string, apiKey: string, model: strin
         model,
         messages: [{ role: 'user', content: prompt }],
         temperature: options.temperature || 0.7,
-        max_tokens: options.max_tokens || 2000
+        max_tokens: options.max_tokens || 2000,
+        ...(options.onToken ? { stream: true } : {})
       })
     })
 
+    if (options.onToken && response.ok) {
+      let content = ''
+      let tokensUsed: number | undefined
+      await readEventStream(response, data => {
+        const chunk = JSON.parse(data)
+        const text = chunk.choices?.[0]?.delta?.content
+        if (text) {
+          content += text
+          options.onToken(text)
+        }
+        if (chunk.usage) {
+          tokensUsed = chunk.usage.total_tokens
+        }
+      })
+      return { model, content, tokens_used: tokensUsed, latency_ms: Date.now() - startTime }
+    }
+
     const data = await response.json()
     const endTime = Date.now()
 
@@ -293,10 +509,83 @@ async function logIOToDatabase(userId: string, input: string, output: Perspectiv
   }
 }
 
+// Server-sent events: `token` {model, content} as text arrives, `model` with each finished
+// ModelResponse, then `done` with the same PerspectivesResponse the JSON endpoint returns
+function streamPerspectives(modelCalls: ModelCall[], userId: string | null, prompt: string) {
+  const encoder = new TextEncoder()
+
+  const body = new ReadableStream({
+    async start(controller) {
+      const send = (event: string, data: any) => {
+        controller.enqueue(encoder.encode(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`))
+      }
+
+      try {
+        const startTime = Date.now()
+        const responses = await Promise.all(modelCalls.map(async ({ model, call }) => {
+          const response = await call(content => send('token', { model, content }))
+          send('model', response)
+          return response
+        }))
+
+        const result: PerspectivesResponse = {
+          responses,
+          total_tokens: responses.reduce((sum, r) => sum + (r.tokens_used || 0), 0),
+          total_latency_ms: Date.now() - startTime,
+          cached: false
+        }
+        send('done', result)
+
+        if (userId) {
+          await logIOToDatabase(userId, prompt, result)
+        }
+      } catch (error: any) {
+        send('error', { error: error.message })
+      } finally {
+        controller.close()
+      }
+    }
+  })
+
+  return new Response(body, {
+    headers: {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache, no-transform',
+      'Connection': 'keep-alive'
+    }
+  })
+}
+
 export async function POST(request: NextRequest) {
+  const session: RequestSession = { userId: null }
+  const response = await handlePerspectives(request, session)
+
+  // Capabilities the CLI negotiates against: compressed bodies and snippet references.
+  // Snippets are only kept for authenticated users; anyone else sends context inline
+  response.headers.set('Accept-Encoding', Object.keys(REQUEST_DECODERS).join(', '))
+  if (session.userId) {
+    response.headers.set('X-Polydev-Features', 'context-snippets')
+    response.headers.set('X-Polydev-Snippet-TTL', String(SNIPPET_TTL_SECONDS))
+  }
+  return response
+}
+
+// The bearer token from the Authorization header, which the CLI sends as POLYDEV_API_TOKEN
+function bearerToken(request: NextRequest): string | undefined {
+  const match = /^Bearer\s+(\S+)$/i.exec(request.headers.get('authorization') || '')
+  return match ? match[1] : undefined
+}
+
+async function handlePerspectives(request: NextRequest, session: RequestSession): Promise<Response> {
   try {
-    const body: GetPerspectivesRequest = await request.json()
-    const { 
+    const body = await readRequestBody(request)
+    if (!body) {
+      return NextResponse.json({
+        error: `Unsupported Content-Encoding: ${request.headers.get('content-encoding')}`
+      }, { status: 415 })
+    }
+
+    const {
       prompt,
       user_token,
       models = DEFAULT_MODELS, 
@@ -305,7 +594,9 @@ export async function POST(request: NextRequest) {
       max_messages = 10,
       temperature = 0.7,
       max_tokens = 2000,
-      project_context = {}
+      stream = false,
+      project_context = {},
+      context_snippets
     } = body
 
     if (!prompt?.trim()) {
@@ -340,9 +631,10 @@ export async function POST(request: NextRequest) {
         }, { status: 400 })
       }
     } else {
-      // Managed mode - validate MCP token if provided
-      if (user_token) {
-        const tokenData = await validateUserToken(user_token)
+      // Managed mode - validate MCP token if provided, in the body or as a bearer token
+      const token = user_token || bearerToken(request)
+      if (token) {
+        const tokenData = await validateUserToken(token)
         if (!tokenData) {
           return NextResponse.json({ 
             error: 'Invalid token. Generate a new one at: https://polydev.ai/dashboard/mcp-tools' 
@@ -356,40 +648,60 @@ export async function POST(request: NextRequest) {
       availableKeys = managedKeys
     }
 
+    session.userId = userId
+
     // Build the enhanced prompt with project context
     let enhancedPrompt = prompt
-    if (project_memory !== 'none' && project_context.root_path) {
+    if (context_snippets) {
+      const refused = checkContextSnippets(context_snippets)
+      if (refused) {
+        return NextResponse.json({ error: refused.error }, { status: refused.status })
+      }
+
+      // Context selected by the CLI; ask for any snippets we no longer hold
+      const { texts, missing, invalid } = await resolveContextSnippets(context_snippets, userId)
+      if (invalid) {
+        return NextResponse.json({ error: `Context snippet ${invalid} does not match its content` }, { status: 400 })
+      }
+      if (missing) {
+        return NextResponse.json({
+          error: 'Unknown context snippets',
+          missing_snippets: missing
+        }, { status: 409 })
+      }
+      enhancedPrompt = `Context from project:\n${joinSnippets(texts!)}\n\nPrompt: ${prompt}`
+    } else if (project_memory !== 'none' && project_context.root_path) {
       // TODO: Implement TF-IDF snippet selection
       enhancedPrompt = `Context: [Project context would be added here based on ${project_memory} mode]\n\nPrompt: ${prompt}`
     }
 
     // Fan out to multiple models in parallel
-    const modelCalls: Promise<ModelResponse>[] = []
+    const modelCalls: ModelCall[] = []
     
     models.forEach(model => {
       // OpenAI models
       if (model.startsWith('gpt-') && availableKeys.openai) {
-        modelCalls.push(callOpenAI(enhancedPrompt, availableKeys.openai, model, { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callOpenAI(enhancedPrompt, availableKeys.openai, model, { temperature, max_tokens, onToken }) })
       }
       // Anthropic models 
       else if (model.startsWith('claude-') && availableKeys.anthropic) {
-        modelCalls.push(callAnthropic(enhancedPrompt, availableKeys.anthropic, model, { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callAnthropic(enhancedPrompt, availableKeys.anthropic, model, { temperature, max_tokens, onToken }) })
       }
       // Google models
       else if (model.startsWith('gemini-') && availableKeys.google) {
-        modelCalls.push(callGemini(enhancedPrompt, availableKeys.google, model, { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callGemini(enhancedPrompt, availableKeys.google, model, { temperature, max_tokens, onToken }) })
       }
       // Groq models (OpenAI-compatible)
       else if ((model.includes('llama') || model.includes('mixtral') || model.includes('gemma')) && availableKeys.groq) {
-        modelCalls.push(callOpenAICompatible(enhancedPrompt, availableKeys.groq, model, 'https://api.groq.com/openai/v1/', { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callOpenAICompatible(enhancedPrompt, availableKeys.groq, model, 'https://api.groq.com/openai/v1/', { temperature, max_tokens, onToken }) })
       }
       // Together AI models (OpenAI-compatible)
       else if (availableKeys.together && model.includes('/')) {
-        modelCalls.push(callOpenAICompatible(enhancedPrompt, availableKeys.together, model, 'https://api.together.xyz/v1/', { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callOpenAICompatible(enhancedPrompt, availableKeys.together, model, 'https://api.together.xyz/v1/', { temperature, max_tokens, onToken }) })
       }
       // Perplexity models (OpenAI-compatible)
       else if (model.includes('sonar') && availableKeys.perplexity) {
-        modelCalls.push(callOpenAICompatible(enhancedPrompt, availableKeys.perplexity, model, 'https://api.perplexity.ai/', { temperature, max_tokens }))
+        modelCalls.push({ model, call: onToken => callOpenAICompatible(enhancedPrompt, availableKeys.perplexity, model, 'https://api.perplexity.ai/', { temperature, max_tokens, onToken }) })
       }
     })
 
@@ -399,8 +711,12 @@ export async function POST(request: NextRequest) {
       }, { status: 400 })
     }
 
+    if (stream) {
+      return streamPerspectives(modelCalls, userId, prompt)
+    }
+
     const startTime = Date.now()
-    const responses = await Promise.all(modelCalls)
+    const responses = await Promise.all(modelCalls.map(({ call }) => call()))
     const totalLatency = Date.now() - startTime
 
     const result: PerspectivesResponse = {